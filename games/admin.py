@@ -1,44 +1,135 @@
 import logging
 import csv
-from datetime import datetime
+import os
+from datetime import date, datetime
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as DjangoUserAdmin
+from django.conf import settings
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
 from django.utils.html import format_html
-from django.http import HttpResponse
+from django.http import (FileResponse, Http404, HttpRequest, QueryDict,
+                         StreamingHttpResponse)
+from django.db.models.constants import LOOKUP_SEP
 from allauth.socialaccount.models import (SocialApp, SocialAccount,
                                           SocialToken)
 from .models import (CustomUser, Address, Product, ProductTag,
                      Order, OrderLine, ProductImage, Payment, Coupon)
+from .profiling import read_slow_queries
+from .tasks import export_to_csv_file
 
 logger = logging.getLogger(__name__)
 
 
-def export_to_csv(modeladmin, request, queryset):
+EXPORT_CHUNK_SIZE = 2000
+SLOW_QUERIES_SHOWN = 100
+
+
+class Echo:
+    """
+    Pseudo-buffer implementing only 'write' method of the file-like
+    interface: csv.writer returns written row instead of storing it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def get_export_fields(modeladmin):
+    """
+    Return list of lookups and list of headers for CSV export.
+    ModelAdmin can define 'csv_export_fields' with lookups spanning
+    relations, otherwise every concrete field is exported.
+    """
     opts = modeladmin.model._meta
-    content_disposition = 'attachment; filename={opts.verbose_name}.csv'
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = content_disposition
-    writer = csv.writer(response)
+    lookups = getattr(modeladmin, 'csv_export_fields', None)
+    if not lookups:
+        lookups = [field.name for field in opts.concrete_fields]
 
-    fields = [field for field in opts.get_fields() if not
-              field.many_to_many and not field.one_to_many]
+    headers = []
+    for lookup in lookups:
+        field = opts.get_field(lookup.split(LOOKUP_SEP)[0])
+        headers.append(field.verbose_name)
+    return lookups, headers
+
+
+def get_export_queryset(modeladmin, user, pks=None, filters=None):
+    """
+    Rebuild queryset of objects selected in the changelist: either
+    the selected primary keys, or when every object was selected,
+    the changelist filtered with query string 'filters' as 'user'.
+    """
+    if filters is None:
+        return modeladmin.model._default_manager.filter(pk__in=pks)
+    request = HttpRequest()
+    request.GET = QueryDict(filters)
+    request.user = user
+    return modeladmin.get_changelist_instance(request).get_queryset(request)
+
+
+def format_export_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%d/%m/%Y')
+    return value
+
+
+def iter_csv_rows(queryset, lookups, headers):
+    """
+    Yield CSV rows one by one. Rows are fetched with a single joined
+    query through a server-side cursor of EXPORT_DATABASE, so memory
+    usage does not depend on the number of exported rows.
+    """
+    writer = csv.writer(Echo())
     # Write a first row with header information
-    writer.writerow([field.verbose_name for field in fields])
+    yield writer.writerow(headers)
     # Write data rows
-    for obj in queryset:
-        data_row = []
-        for field in fields:
-            value = getattr(obj, field.name)
-            if isinstance(value, datetime):
-                value = value.strftime('%d/%m/%Y')
-            data_row.append(value)
-        writer.writerow(data_row)
+    rows = queryset.using(settings.EXPORT_DATABASE).values_list(
+        *lookups).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    for row in rows:
+        yield writer.writerow([format_export_value(value) for value in row])
+
+
+def export_to_csv(modeladmin, request, queryset):
+    opts = modeladmin.model._meta
+    content_disposition = 'attachment; filename={}.csv'.format(
+        opts.verbose_name)
+    lookups, headers = get_export_fields(modeladmin)
+    response = StreamingHttpResponse(
+        iter_csv_rows(queryset, lookups, headers),
+        content_type='text/csv'
+    )
+    response['Content-Disposition'] = content_disposition
     return response
 
 
 export_to_csv.short_description = 'Export to CSV'
 
 
+def export_to_csv_in_background(modeladmin, request, queryset):
+    """
+    Export large querysets with a Celery task, download link is sent
+    to the staff user by e-mail.
+    """
+    opts = modeladmin.model._meta
+    # Task receives the selection, not the query, so the worker
+    # rebuilds the queryset itself
+    if request.POST.get('select_across') == '1':
+        selection = {'filters': request.GET.urlencode()}
+    else:
+        selection = {'pks': list(queryset.values_list('pk', flat=True))}
+    result = export_to_csv_file.delay(
+        opts.label, request.user.pk, **selection)
+    modeladmin.message_user(
+        request,
+        'Export of {0} started (task {1}). Download link will be '
+        'sent to {2}.'.format(opts.verbose_name_plural, result.id,
+                              request.user.email)
+    )
+
+
+export_to_csv_in_background.short_description = 'Export to CSV in background'
+
+
 class AddressInline(admin.TabularInline):
     model = Address
 
@@ -123,8 +214,8 @@ class OrderLineInline(admin.TabularInline):
     model = OrderLine
     extra = 0
     raw_id_fields = ('product',)
-    fields = ('product', 'status', 'quantity')
-    readonly_fields = ('quantity',)
+    fields = ('product', 'status', 'quantity', 'unit_price', 'total_price')
+    readonly_fields = ('quantity', 'unit_price', 'total_price')
     can_delete = False
 
 
@@ -137,7 +228,11 @@ class OrderAdmin(admin.ModelAdmin):
     list_filter = ('status', 'shipping_address__country', 'date_added')
     search_fields = ['user__email']
     inlines = [OrderLineInline]
-    actions = [export_to_csv]
+    actions = [export_to_csv, export_to_csv_in_background]
+    csv_export_fields = ('id', 'user__email', 'status',
+                         'billing_address__street_address',
+                         'shipping_address__street_address',
+                         'payment__amount', 'date_updated', 'date_added')
 
 
 class AddressAdmin(admin.ModelAdmin):
@@ -164,6 +259,48 @@ class MyAdminSite(admin.AdminSite):
     def has_permission(self, request):
         return request.user.is_staff
 
+    def get_urls(self):
+        urls = [
+            path('slow-queries/', self.admin_view(self.slow_queries_view),
+                 name='slow-queries'),
+            path('exports/<str:filename>',
+                 self.admin_view(self.export_download_view),
+                 name='export-download'),
+        ]
+        return urls + super().get_urls()
+
+    def index(self, request, extra_context=None):
+        extra_context = extra_context or {}
+        extra_context['reporting_pages'] = [
+            {'name': 'Slow queries',
+             'link': reverse('{}:slow-queries'.format(self.name))},
+        ]
+        return super().index(request, extra_context)
+
+    def export_download_view(self, request, filename):
+        """
+        Serve CSV export made in background to staff only.
+        """
+        path = os.path.join(settings.EXPORT_ROOT, os.path.basename(filename))
+        if not os.path.isfile(path):
+            raise Http404
+        return FileResponse(open(path, 'rb'), as_attachment=True,
+                            filename=os.path.basename(path))
+
+    def slow_queries_view(self, request):
+        """
+        Show the latest queries logged by query profiling.
+        """
+        context = dict(
+            self.each_context(request),
+            title='Slow queries',
+            profiling_enabled=settings.QUERY_PROFILING_ENABLED,
+            threshold=settings.QUERY_PROFILING_THRESHOLD,
+            entries=read_slow_queries(SLOW_QUERIES_SHOWN),
+        )
+        request.current_app = self.name
+        return TemplateResponse(request, 'admin/slow_queries.html', context)
+
 
 new_admin = MyAdminSite(name='myadmin')
 new_admin.register(CustomUser, CustomerUserAdmin)
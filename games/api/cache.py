@@ -0,0 +1,85 @@
+import hashlib
+from datetime import datetime, time, timedelta
+from functools import wraps
+from django.core.cache import cache
+from django.utils import timezone
+from django.views.decorators.http import condition
+from rest_framework import status
+from rest_framework.response import Response
+
+
+ANALYTICS_VERSION_KEY = 'analytics_last_modified'
+
+
+def invalidate_analytics_cache():
+    """
+    Mark cached analytics responses as outdated. Called after
+    statistics of paid orders are updated.
+    """
+    cache.set(ANALYTICS_VERSION_KEY, timezone.now().timestamp(), None)
+
+
+def get_analytics_last_modified():
+    """
+    Return time of the last analytics update. Responses also depend
+    on current day, so it is never earlier than today's midnight.
+    """
+    timestamp = cache.get(ANALYTICS_VERSION_KEY)
+    if timestamp is None:
+        timestamp = timezone.now().timestamp()
+        cache.set(ANALYTICS_VERSION_KEY, timestamp, None)
+    last_modified = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    today = timezone.make_aware(
+        datetime.combine(timezone.localdate(), time.min))
+    return max(last_modified, today)
+
+
+def get_analytics_cache_key(request):
+    return 'analytics:{0}:{1}'.format(
+        request.get_full_path(),
+        get_analytics_last_modified().timestamp())
+
+
+def get_analytics_timeout(period=None):
+    """
+    Cache longer periods for longer: they are more expensive to
+    compute. Cached data expire at midnight as period is shifted.
+    """
+    now = timezone.localtime()
+    midnight = datetime.combine(now.date() + timedelta(days=1), time.min)
+    until_midnight = (timezone.make_aware(midnight) - now).total_seconds()
+    if period is None:
+        return int(until_midnight)
+    return int(min(until_midnight, period * 2 * 60))
+
+
+def analytics_etag(request, *args, **kwargs):
+    key = get_analytics_cache_key(request)
+    return '"{}"'.format(hashlib.md5(key.encode()).hexdigest())
+
+
+def analytics_last_modified(request, *args, **kwargs):
+    return get_analytics_last_modified()
+
+
+def cache_analytics(func):
+    """
+    Decorator to cache analytics data until the next update and answer
+    conditional requests with 304 Not Modified. Period, if the view
+    takes one, is the first argument.
+    """
+    @wraps(func)
+    def wrapper(request, *args, **kwargs):
+        key = get_analytics_cache_key(request)
+        content = cache.get(key)
+        if content is not None:
+            return Response(content, status=status.HTTP_200_OK)
+
+        response = func(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            period = args[0] if args else kwargs.get('period')
+            cache.set(key, response.data, get_analytics_timeout(period))
+        return response
+
+    return condition(etag_func=analytics_etag,
+                     last_modified_func=analytics_last_modified)(wrapper)
@@ -1,7 +1,59 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import (BasePagination, PageNumberPagination,
+                                       CursorPagination)
 
 
 class PageSizePagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 50
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Paginate by position of the last seen row instead of OFFSET,
+    so deep pages cost the same as the first one and no COUNT(*)
+    is made.
+    """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 50
+    # Cursor holds the position of the first ordering field only, so it
+    # must be unique; newest rows have the highest ids
+    ordering = ('-id',)
+
+    def get_ordering(self, request, queryset, view):
+        # Ordering of the view or of 'ordering' parameter is ignored
+        return self.ordering
+
+
+class OptInKeysetPagination(BasePagination):
+    """
+    Paginate with 'default_pagination_class' unless request contains
+    'cursor' parameter, then switch to keyset pagination.
+    If 'default_pagination_class' is None results are not paginated
+    by default.
+    """
+    default_pagination_class = PageSizePagination
+    keyset_pagination_class = KeysetPagination
+
+    paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        cursor_query_param = self.keyset_pagination_class.cursor_query_param
+        if cursor_query_param in request.query_params:
+            pagination_class = self.keyset_pagination_class
+        else:
+            pagination_class = self.default_pagination_class
+
+        if pagination_class is None:
+            return None
+
+        self.paginator = pagination_class()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+
+class OptInOnlyKeysetPagination(OptInKeysetPagination):
+    default_pagination_class = None
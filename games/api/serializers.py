@@ -1,5 +1,6 @@
-from rest_framework.serializers import (ModelSerializer, ReadOnlyField,
-                                        ChoiceField, DateTimeField)
+from rest_framework.serializers import (Serializer, ModelSerializer,
+                                        ReadOnlyField, ChoiceField,
+                                        DateTimeField, IntegerField)
 from ..models import Order, OrderLine, Cart, CartLine
 
 
@@ -15,8 +16,17 @@ class OrderLineSerializer(ModelSerializer):
         fields = ('id',
                   'product',
                   'quantity',
+                  'unit_price',
+                  'total_price',
                   'status',
                   'status_description')
+        read_only_fields = ('unit_price', 'total_price')
+
+
+class OrderLineStatusSerializer(Serializer):
+    id = IntegerField()
+    status = ChoiceField(
+        choices=OrderLine.STATUSES)
 
 
 class OrderSerializer(ModelSerializer):
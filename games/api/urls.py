@@ -1,7 +1,7 @@
 from django.urls import path
-from .views import (OrderList, OrderLinePartialUpdate,
+from .views import (OrderList, OrderLinePartialUpdate, OrderLineBulkUpdate,
                     IsUserStaff, OrderDetail, CartList,
-                    orders_per_day, most_bought_products,
+                    orders_per_day, most_bought_products, order_stats,
                     add_to_cart, remove_single_from_cart,
                     remove_from_cart)
 
@@ -13,6 +13,8 @@ urlpatterns = [
 
     path('order-lines/<int:pk>', OrderLinePartialUpdate.as_view(),
          name=OrderLinePartialUpdate.name),
+    path('order-lines/', OrderLineBulkUpdate.as_view(),
+         name=OrderLineBulkUpdate.name),
 
     path('is-user-staff/', IsUserStaff.as_view(),
          name=IsUserStaff.name),
@@ -26,6 +28,9 @@ urlpatterns = [
     path('most-bought-products/<int:period>', most_bought_products,
          name='api-most-bought-products'),
 
+    path('order-stats/', order_stats,
+         name='api-order-stats'),
+
     # APIS FOR FUTHER FRONTEND ON REACT
 
     path('add-to-cart/<slug>', add_to_cart,
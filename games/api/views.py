@@ -2,22 +2,25 @@ from functools import wraps
 from datetime import timedelta
 from django.utils import timezone
 from django.http import JsonResponse
-from django.db.models import Count, Q
-from django.db.models.functions import TruncDay
+from django.db.models import F, Sum, Prefetch
+from django.db.models.functions import TruncWeek, TruncMonth
 from rest_framework import status
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView, RetrieveAPIView, GenericAPIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.mixins import UpdateModelMixin
 from rest_framework.decorators import api_view, permission_classes
 from django.shortcuts import get_object_or_404
 from django_filters import DateTimeFilter, ChoiceFilter
 from django_filters.rest_framework import FilterSet
-from ..models import Order, OrderLine, Cart, CartLine, Product
-from .serializers import OrderSerializer, OrderLineSerializer, CartSerializer
+from ..models import (Order, OrderLine, Cart, CartLine, Product,
+                      DailyOrderStats, DailyProductStats)
+from .serializers import (OrderSerializer, OrderLineSerializer,
+                          OrderLineStatusSerializer, CartSerializer)
 from .permissions import IsStaff, IsOrderOwner
-from .pagination import PageSizePagination
+from .pagination import OptInKeysetPagination, OptInOnlyKeysetPagination
+from .cache import cache_analytics
 
 
 class OrderFilter(FilterSet):
@@ -34,18 +37,44 @@ class OrderFilter(FilterSet):
                   'to_date')
 
 
+def get_order_queryset():
+    """
+    Return orders with every relation used by OrderSerializer
+    loaded in constant number of queries.
+    """
+    lines = OrderLine.objects.select_related('product')
+    return Order.objects.select_related(
+        'user', 'shipping_address', 'billing_address'
+    ).prefetch_related(Prefetch('lines', queryset=lines))
+
+
+class OrderStatsFilter(FilterSet):
+    from_date = DateTimeFilter(
+        field_name='day', lookup_expr='gte')
+    to_date = DateTimeFilter(
+        field_name='day', lookup_expr='lte')
+
+    class Meta:
+        model = DailyOrderStats
+        fields = ('from_date',
+                  'to_date')
+
+
 class OrderList(ListAPIView):
     """
     Return list of user's orders.
     If user is staff return list of all existing orders.
+    Pass 'cursor' parameter to use keyset pagination, newest orders
+    first whatever 'ordering' is.
     """
-    queryset = Order.objects.all()
+    queryset = get_order_queryset()
     serializer_class = OrderSerializer
-    pagination_class = PageSizePagination
+    pagination_class = OptInKeysetPagination
     permission_classes = [IsAuthenticated]
     filterset_class = OrderFilter
     search_fields = ('^user__email',)
     ordering_fields = ('date_added',)
+    ordering = ('-date_added', '-id')
     name = 'order-list'
 
     def get_queryset(self):
@@ -60,7 +89,7 @@ class OrderDetail(RetrieveAPIView):
     """
     Return details of user's order.
     """
-    queryset = Order.objects.all()
+    queryset = get_order_queryset()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated, IsOrderOwner]
     name = 'order-detail'
@@ -79,6 +108,39 @@ class OrderLinePartialUpdate(UpdateModelMixin, GenericAPIView):
         return self.partial_update(request, *args, **kwargs)
 
 
+class OrderLineBulkUpdate(APIView):
+    """
+    Update statuses of many order's lines at once
+    (list of {'id': ..., 'status': ...}).
+    """
+    # IsStaff checks object permissions only
+    permission_classes = [IsAuthenticated, IsAdminUser]
+    name = 'order-lines-bulk'
+
+    def patch(self, request, *args, **kwargs):
+        serializer = OrderLineStatusSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+
+        statuses = {line['id']: line['status']
+                    for line in serializer.validated_data}
+        if len(statuses) != len(serializer.validated_data):
+            content = {'error': 'Order lines are duplicated.'}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = OrderLine.objects.filter(pk__in=list(statuses))
+        missing = set(statuses) - set(lines.values_list('pk', flat=True))
+        if missing:
+            content = {'error': 'Order lines do not exist.',
+                       'ids': sorted(missing)}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        OrderLine.objects.update_statuses(statuses)
+
+        lines = lines.select_related('product').order_by('pk')
+        serializer = OrderLineSerializer(lines, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+
 class IsUserStaff(APIView):
     """
     Return 'true' if user is staff, otherwise return 'false'.
@@ -94,9 +156,13 @@ class IsUserStaff(APIView):
 class CartList(ListAPIView):
     """
     Return list of user's carts.
+    Pass 'cursor' parameter to paginate results.
     """
     queryset = Cart.objects.all()
     serializer_class = CartSerializer
+    pagination_class = OptInOnlyKeysetPagination
+    # Cart has no creation date, newest carts have the highest ids
+    ordering = ('-id',)
     name = 'cart-list'
 
     def get_queryset(self):
@@ -105,6 +171,19 @@ class CartList(ListAPIView):
         return queryset.filter(user=user)
 
 
+PRODUCT_RANKINGS = {
+    'quantity': '-purchase_num',
+    'revenue': '-revenue',
+}
+
+
+STATS_GRANULARITIES = {
+    'day': F('day'),
+    'week': TruncWeek('day'),
+    'month': TruncMonth('day'),
+}
+
+
 def period_is_valid(func):
     """
     Decorator to check if period is valid.
@@ -121,41 +200,83 @@ def period_is_valid(func):
 
 @period_is_valid
 @api_view(['GET'])
-@permission_classes([IsAuthenticated, IsStaff])
+@permission_classes([IsAuthenticated, IsAdminUser])
+@cache_analytics
 def orders_per_day(request, period):
     """
     Show number of paid orders per day in chosen period.
     """
     starting_day = timezone.now() - timedelta(period)
-    order_data = (Order.objects.filter(
-        (Q(status=Order.PAID) | Q(status=Order.DONE))
-        & Q(payment__date_paid__gt=starting_day))
-        .annotate(day=TruncDay('payment__date_paid'))
-        .values('day')
-        .annotate(c=Count('id'))
+    order_data = (DailyOrderStats.objects.filter(
+        day__gt=starting_day, order_num__gt=0)
+        .order_by('day')
+        .values_list('day', 'order_num')
     )
-    content = [{'order_day': x['day'].strftime('%Y-%m-%d'), 'order_num': x['c']}
-               for x in order_data]
+    content = [{'order_day': day.strftime('%Y-%m-%d'), 'order_num': num}
+               for day, num in order_data]
     return Response(content, status=status.HTTP_200_OK)
 
 
 @period_is_valid
 @api_view(['GET'])
-@permission_classes([IsAuthenticated, IsStaff])
+@permission_classes([IsAuthenticated, IsAdminUser])
+@cache_analytics
 def most_bought_products(request, period):
     """
     Show products and its number of purchases in chosen period.
+    Products are ranked by bought quantity or, if 'ranking' parameter
+    is 'revenue', by revenue.
     """
+    ranking = request.query_params.get('ranking', 'quantity')
+    if ranking not in PRODUCT_RANKINGS:
+        content = {'error': 'Invalid ranking.'}
+        return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
     starting_day = timezone.now() - timedelta(period)
     data = (
-        OrderLine.objects.filter(
-            (Q(order__status=Order.PAID) | Q(order__status=Order.DONE))
-            & Q(order__date_added__gt=starting_day))
+        DailyProductStats.objects.filter(day__gt=starting_day)
         .values('product__name')
-        .annotate(c=Count('id'))
-        .order_by('-c')[:6]
+        .annotate(purchase_num=Sum('quantity'), revenue=Sum('revenue'))
+        .order_by(PRODUCT_RANKINGS[ranking])[:6]
+    )
+    content = [{'product_name': x['product__name'],
+                'purchase_num': x['purchase_num'],
+                'revenue': x['revenue']}
+               for x in data]
+    return Response(content, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated, IsAdminUser])
+@cache_analytics
+def order_stats(request):
+    """
+    Show number of paid orders and revenue in date range
+    ('from_date', 'to_date', both inclusive) grouped by day,
+    week or month ('granularity').
+    Weeks and months are summed up from daily statistics, so cost
+    depends only on number of days in range.
+    """
+    granularity = request.query_params.get('granularity', 'day')
+    if granularity not in STATS_GRANULARITIES:
+        content = {'error': 'Invalid granularity.'}
+        return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+    filterset = OrderStatsFilter(request.query_params,
+                                 queryset=DailyOrderStats.objects.all())
+    if not filterset.is_valid():
+        return Response(filterset.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    data = (
+        filterset.qs
+        .annotate(period_start=STATS_GRANULARITIES[granularity])
+        .values('period_start')
+        .annotate(order_num=Sum('order_num'), revenue=Sum('revenue'))
+        .order_by('period_start')
     )
-    content = [{'product_name': x['product__name'], 'purchase_num': x['c']}
+    content = [{'period_start': x['period_start'].strftime('%Y-%m-%d'),
+                'order_num': x['order_num'],
+                'revenue': x['revenue']}
                for x in data]
     return Response(content, status=status.HTTP_200_OK)
 
@@ -0,0 +1,268 @@
+"""
+Benchmarks of storefront hot paths: catalogs and order histories of
+given scale are generated with factories, then every scenario is
+requested through the whole middleware stack measuring latency,
+throughput and number of database queries.
+Run with 'python manage.py benchmark'.
+"""
+import random
+import statistics
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from . import factories, models
+from .api.cache import invalidate_analytics_cache
+
+
+# Number of products and order lines
+Scale = namedtuple('Scale', ['products', 'order_lines'])
+
+SCALES = {
+    'tiny': Scale(50, 500),
+    'small': Scale(1000, 10000),
+    'medium': Scale(10000, 100000),
+    'large': Scale(100000, 1000000),
+}
+
+DAYS = 360
+LINES_PER_ORDER = 4
+ORDERS_PER_USER = 10
+NUMBER_OF_TAGS = 20
+BATCH_SIZE = 5000
+
+
+def populate(scale, stdout=None):
+    """
+    Fill database with products, users and paid orders spread over
+    last DAYS days, then rebuild analytics statistics.
+    """
+    def log(message):
+        if stdout:
+            stdout.write(message)
+
+    models.ProductTag.objects.bulk_create([
+        models.ProductTag(name='Tag {}'.format(i), slug='tag-{}'.format(i))
+        for i in range(NUMBER_OF_TAGS)])
+    # primary keys are set by bulk_create only on PostgreSQL
+    tags = list(models.ProductTag.objects.all())
+    models.Product.objects.bulk_create(
+        factories.ProductFactory.build_batch(scale.products),
+        batch_size=BATCH_SIZE)
+    products = list(models.Product.objects.all())
+    tagged = models.Product.tags.through
+    tagged.objects.bulk_create(
+        [tagged(product_id=product.pk, producttag_id=random.choice(tags).pk)
+         for product in products],
+        batch_size=BATCH_SIZE)
+    log('Products created={}'.format(len(products)))
+
+    number_of_orders = max(1, scale.order_lines // LINES_PER_ORDER)
+    get_user_model().objects.bulk_create(
+        factories.UserFactory.build_batch(
+            max(1, number_of_orders // ORDERS_PER_USER)),
+        batch_size=BATCH_SIZE)
+    users = list(get_user_model().objects.all())
+    log('Users created={}'.format(len(users)))
+
+    today = timezone.localdate()
+    orders_per_day = max(1, number_of_orders // DAYS)
+    created_lines = 0
+    for day in range(DAYS):
+        if created_lines >= scale.order_lines:
+            break
+        date = today - timedelta(days=day)
+        created_lines += create_orders(date, orders_per_day, users, products)
+    log('Order lines created={}'.format(created_lines))
+
+    from_day = today - timedelta(days=DAYS)
+    models.DailyOrderStats.objects.rebuild(from_day)
+    models.DailyProductStats.objects.rebuild(from_day)
+
+
+def create_orders(date, number_of_orders, users, products):
+    """
+    Create paid orders of the day with LINES_PER_ORDER lines on average.
+    Return number of created lines.
+    """
+    baskets = [random.sample(products, k=random.randint(
+        1, min(2 * LINES_PER_ORDER - 1, len(products))))
+        for _ in range(number_of_orders)]
+    order_users = [random.choice(users) for _ in baskets]
+
+    last_payment = models.Payment.objects.order_by('pk').last()
+    models.Payment.objects.bulk_create([
+        factories.PaymentFactory.build(
+            user=user,
+            amount=sum(p.discount_price or p.price for p in basket))
+        for user, basket in zip(order_users, baskets)])
+    payments = models.Payment.objects.filter(
+        pk__gt=last_payment.pk if last_payment else 0).order_by('pk')
+    payments.update(date_paid=date)
+
+    last_order = models.Order.objects.order_by('pk').last()
+    models.Order.objects.bulk_create([
+        factories.OrderFactory.build(user=user, payment=payment,
+                                     status=models.Order.PAID,
+                                     confirmation_sent=timezone.now())
+        for user, payment in zip(order_users, payments)])
+    orders = models.Order.objects.filter(
+        pk__gt=last_order.pk if last_order else 0).order_by('pk')
+    orders.update(date_added=timezone.make_aware(
+        datetime.combine(date, datetime.min.time())))
+
+    lines = [factories.OrderLineFactory.build(order=order, product=product)
+             for order, basket in zip(orders, baskets)
+             for product in basket]
+    models.OrderLine.objects.bulk_create(lines, batch_size=BATCH_SIZE)
+    return len(lines)
+
+
+class Benchmark(object):
+    """
+    Scenarios of storefront hot paths. Every scenario has optional
+    'prepare_<name>' method run before each request, not measured,
+    and 'request_<name>' method making the measured request.
+    """
+    scenarios = ['home', 'product_detail', 'search', 'add_to_cart',
+                 'checkout', 'payment', 'api_orders_per_day',
+                 'api_most_bought_products', 'api_order_stats']
+
+    def __init__(self):
+        self.products = list(models.Product.objects.all())
+        self.user = factories.UserFactory.create(
+            email='benchmark@example.com')
+        self.staff = factories.UserFactory.create(
+            email='benchmark-staff@example.com')
+        self.staff.is_staff = True
+        self.staff.save()
+        self.anonymous_client = Client()
+        self.client = Client()
+        self.client.force_login(self.user)
+        self.staff_client = Client()
+        self.staff_client.force_login(self.staff)
+
+    def random_product(self):
+        return random.choice(self.products)
+
+    def fill_cart(self, number_of_products=3):
+        cart = models.Cart.objects.create(user=self.user)
+        models.CartLine.objects.bulk_create([
+            models.CartLine(cart=cart, product=product)
+            for product in random.sample(self.products, k=min(
+                number_of_products, len(self.products)))])
+        session = self.client.session
+        session['cart_id'] = cart.pk
+        session.save()
+        return cart
+
+    def request_home(self, prepared):
+        return self.anonymous_client.get(reverse('games:home'))
+
+    def request_product_detail(self, prepared):
+        return self.anonymous_client.get(
+            self.random_product().get_absolute_url())
+
+    def request_search(self, prepared):
+        return self.anonymous_client.get(
+            reverse('games:search'),
+            {'query': self.random_product().name})
+
+    def prepare_add_to_cart(self):
+        # every visitor starts with an empty cart
+        self.anonymous_client = Client()
+
+    def request_add_to_cart(self, prepared):
+        return self.anonymous_client.get(
+            self.random_product().get_add_to_cart_url())
+
+    def prepare_checkout(self):
+        return self.fill_cart()
+
+    def request_checkout(self, prepared):
+        return self.client.get(reverse('games:checkout'))
+
+    def prepare_payment(self):
+        cart = self.fill_cart()
+        models.Order.objects.create(user=self.user)
+        return cart
+
+    def request_payment(self, prepared):
+        return self.client.post(reverse('games:payment'))
+
+    def prepare_api_orders_per_day(self):
+        # measure computation, not the cached response
+        invalidate_analytics_cache()
+
+    def request_api_orders_per_day(self, prepared):
+        return self.staff_client.get(
+            reverse('games:api-orders-per-day', kwargs={'period': 30}))
+
+    prepare_api_most_bought_products = prepare_api_orders_per_day
+
+    def request_api_most_bought_products(self, prepared):
+        return self.staff_client.get(
+            reverse('games:api-most-bought-products', kwargs={'period': 30}))
+
+    prepare_api_order_stats = prepare_api_orders_per_day
+
+    def request_api_order_stats(self, prepared):
+        return self.staff_client.get(
+            reverse('games:api-order-stats'), {'granularity': 'week'})
+
+    def run_scenario(self, name, number_of_requests):
+        """
+        Return latency in milliseconds, throughput and query counts
+        of the scenario.
+        """
+        prepare = getattr(self, 'prepare_' + name, None)
+        request = getattr(self, 'request_' + name)
+        latencies, queries, errors = [], [], 0
+
+        for _ in range(number_of_requests):
+            prepared = prepare() if prepare else None
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                try:
+                    response = request(prepared)
+                    if response.status_code >= 400:
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context.captured_queries))
+
+        latencies.sort()
+        return {
+            'requests': number_of_requests,
+            'errors': errors,
+            'throughput': round(1000 * len(latencies) / sum(latencies), 2),
+            'latency_mean': round(statistics.mean(latencies), 3),
+            'latency_median': round(statistics.median(latencies), 3),
+            'latency_p95': round(
+                latencies[int(len(latencies) * 0.95) - 1], 3),
+            'latency_max': round(latencies[-1], 3),
+            'queries_mean': round(statistics.mean(queries), 2),
+            'queries_max': max(queries),
+        }
+
+    def cleanup(self):
+        """
+        Delete carts and orders made by scenarios.
+        """
+        models.Cart.objects.filter(user__isnull=True).delete()
+        models.Cart.objects.filter(user=self.user).delete()
+        models.Order.objects.filter(user=self.user).delete()
+        models.Payment.objects.filter(user=self.user).delete()
+
+    def run(self, number_of_requests, scenarios=None):
+        results = {}
+        for name in scenarios or self.scenarios:
+            results[name] = self.run_scenario(name, number_of_requests)
+            self.cleanup()
+        return results
@@ -58,6 +58,11 @@ class OrderLineFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = models.OrderLine
 
+    quantity = 1
+    unit_price = factory.LazyAttribute(
+        lambda o: o.product.discount_price or o.product.price)
+    total_price = factory.LazyAttribute(lambda o: o.unit_price * o.quantity)
+
 
 class OrderFactory(factory.django.DjangoModelFactory):
 
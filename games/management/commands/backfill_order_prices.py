@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from games import models
+
+
+class Command(BaseCommand):
+    """
+    Implement 'backfill_order_prices' command for storing price snapshot
+    of order lines created before prices were stored.
+    """
+    help = 'Fill in prices of order lines in Games4Everyone'
+
+    def add_arguments(self, parser):
+        """
+        Add command's arguments: 'batch size' of updated lines.
+        """
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.stdout.write("Backfilling prices of order lines")
+        updated = models.OrderLine.objects.backfill_prices(
+            batch_size=options["batch_size"])
+        self.stdout.write("Order lines updated={}".format(updated))
@@ -0,0 +1,119 @@
+import copy
+import json
+import subprocess
+import django
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import (override_settings, setup_test_environment,
+                               teardown_test_environment)
+from django.utils import timezone
+from games import models
+from games.benchmarks import SCALES, Benchmark, populate
+
+
+class Command(BaseCommand):
+    """
+    Implement 'benchmark' command for measuring latency, throughput and
+    number of queries of storefront hot paths on generated data.
+    """
+    help = 'Benchmark hot paths of Games4Everyone'
+
+    def add_arguments(self, parser):
+        """
+        Add command's arguments: 'scale' of generated data, 'number of
+        requests' per scenario, scenarios to run and file for results.
+        """
+        parser.add_argument("--scale", choices=list(SCALES), default='small')
+        parser.add_argument("--requests", type=int, default=100)
+        parser.add_argument("--scenario", action='append', dest='scenarios',
+                            choices=Benchmark.scenarios)
+        parser.add_argument("--output", help="write results as JSON")
+        parser.add_argument(
+            "--keepdb", action='store_true',
+            help="keep benchmark database with generated data between runs")
+        parser.add_argument(
+            "--redis-db", type=int, default=15,
+            help="Redis database used by caches and cleared by benchmark")
+
+    def get_caches(self, redis_db):
+        """
+        Return cache settings with every Redis cache moved to a separate
+        database, so clearing it leaves live cache, sessions and Celery
+        broker untouched.
+        """
+        caches_settings = copy.deepcopy(settings.CACHES)
+        for cache_settings in caches_settings.values():
+            location = cache_settings.get('LOCATION', '')
+            if location.startswith('redis://'):
+                cache_settings['LOCATION'] = '{0}/{1}'.format(
+                    location.rsplit('/', 1)[0], redis_db)
+        return caches_settings
+
+    def get_revision(self):
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        # Data is generated in a separate database, the same one tests use
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        # Tasks must see the benchmark database, not the one of workers
+        settings_override = override_settings(
+            CELERY_TASK_ALWAYS_EAGER=True,
+            CACHES=self.get_caches(options['redis_db']))
+        settings_override.enable()
+        try:
+            # Cached pages of development database must not be served
+            for alias in settings.CACHES:
+                caches[alias].clear()
+
+            scale = SCALES[options['scale']]
+            number_of_products = models.Product.objects.count()
+            if number_of_products != scale.products:
+                if number_of_products:
+                    call_command('flush', interactive=False, verbosity=0)
+                self.stdout.write("Generating data of scale '{}'".format(
+                    options['scale']))
+                populate(scale, self.stdout)
+
+            results = Benchmark().run(options['requests'],
+                                      options['scenarios'])
+        finally:
+            settings_override.disable()
+            connection.creation.destroy_test_db(
+                old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        self.stdout.write(
+            "{0:<26} {1:>7} {2:>9} {3:>9} {4:>9} {5:>8}".format(
+                'scenario', 'errors', 'req/s', 'mean ms', 'p95 ms',
+                'queries'))
+        for name, result in results.items():
+            self.stdout.write(
+                "{0:<26} {errors:>7} {throughput:>9.1f} {latency_mean:>9.2f} "
+                "{latency_p95:>9.2f} {queries_mean:>8.1f}".format(
+                    name, **result))
+
+        if options['output']:
+            report = {
+                'scale': options['scale'],
+                'products': scale.products,
+                'order_lines': scale.order_lines,
+                'revision': self.get_revision(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'date': timezone.now().isoformat(),
+                'results': results,
+            }
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+            self.stdout.write("Results written to {}".format(
+                options['output']))
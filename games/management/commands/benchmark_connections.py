@@ -0,0 +1,75 @@
+import statistics
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.test import Client
+from django.urls import reverse
+from games import models
+
+
+class Command(BaseCommand):
+    """
+    Implement 'benchmark_connections' command for comparing latency of
+    home and product pages when every request opens a new database
+    connection and when connections are persistent.
+    """
+    help = 'Benchmark database connection reuse in Games4Everyone'
+
+    def add_arguments(self, parser):
+        """
+        Add command's arguments: 'number of requests' per page and mode.
+        """
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--conn-max-age", type=int, default=60)
+
+    def measure(self, client, url, number_of_requests):
+        """
+        Return latencies of requests to url in milliseconds.
+        """
+        timings = []
+        for _ in range(number_of_requests):
+            start = time.perf_counter()
+            response = client.get(url)
+            # Test client doesn't close connections at the end of request
+            # like request handler does
+            close_old_connections()
+            timings.append((time.perf_counter() - start) * 1000)
+            if response.status_code != 200:
+                raise CommandError('{0} returned {1}'.format(
+                    url, response.status_code))
+        return timings
+
+    def handle(self, *args, **options):
+        product = models.Product.objects.in_stock().first()
+        if product is None:
+            raise CommandError(
+                'To run benchmark there must be products specified')
+
+        host = next((host for host in settings.ALLOWED_HOSTS
+                     if host != '*' and not host.startswith('.')),
+                    'localhost')
+        client = Client(HTTP_HOST=host)
+        urls = [reverse('games:home'), product.get_absolute_url()]
+        connection = connections['default']
+        conn_max_age = connection.settings_dict['CONN_MAX_AGE']
+        modes = (('new connection', 0),
+                 ('persistent connection', options['conn_max_age']))
+
+        self.stdout.write("Benchmarking {0} requests per page".format(
+            options['requests']))
+        try:
+            for mode, max_age in modes:
+                connection.settings_dict['CONN_MAX_AGE'] = max_age
+                connection.close()
+                for url in urls:
+                    # warm up caches and templates
+                    self.measure(client, url, 5)
+                    timings = self.measure(client, url, options['requests'])
+                    self.stdout.write(
+                        "{0:<22} {1:<40} mean={2:.2f}ms p95={3:.2f}ms".format(
+                            mode, url, statistics.mean(timings),
+                            sorted(timings)[int(len(timings) * 0.95) - 1]))
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = conn_max_age
+            connection.close()
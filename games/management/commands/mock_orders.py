@@ -2,6 +2,7 @@ import random
 from django.core.management.base import BaseCommand
 from django.contrib.auth import get_user_model
 from games import models, factories
+from games.api.cache import invalidate_analytics_cache
 
 
 class Command(BaseCommand):
@@ -45,7 +46,9 @@ Did not find any.')
             )
             for product in order_products:
                 orderlines.append(
-                    models.OrderLine(order=order, product=product))
+                    models.OrderLine(order=order, product=product,
+                                     unit_price=product.price,
+                                     total_price=product.price))
                 total_price += product.price
 
             models.OrderLine.objects.bulk_create(orderlines)
@@ -55,7 +58,11 @@ Did not find any.')
             order.payment = payment
             order.status = models.Order.PAID
             order.save()
+            models.DailyOrderStats.objects.add_order(order)
+            models.DailyProductStats.objects.add_order(order)
 
             self.stdout.write(
                 'Order id: {0}, user: {1}, number of lines: {2}'.format(
                     order.id, user.email, len(orderlines)))
+
+        invalidate_analytics_cache()
@@ -0,0 +1,91 @@
+import threading
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+from django.db import connections
+
+
+# Results memoized during the request handled by current thread
+_local = threading.local()
+
+
+def get_memo():
+    return getattr(_local, 'memo', None)
+
+
+def clear():
+    memo = get_memo()
+    if memo is not None:
+        memo.clear()
+
+
+def clear_on_write(execute, sql, params, many, context):
+    """
+    Execute wrapper forgetting memoized results after every query
+    which is not a SELECT, as it might have changed them.
+    """
+    result = execute(sql, params, many, context)
+    if not sql.lstrip()[:6].upper() == 'SELECT':
+        clear()
+    return result
+
+
+@contextmanager
+def clear_on_rollback(connection):
+    """
+    Forget memoized results read in a transaction which is rolled back.
+    Rollback to a savepoint is a query, so it's cleared on write, but
+    rollback of the whole transaction doesn't go through execute
+    wrappers.
+    """
+    rollback = connection.rollback
+
+    @wraps(rollback)
+    def wrapper():
+        try:
+            return rollback()
+        finally:
+            clear()
+
+    connection.rollback = wrapper
+    try:
+        yield
+    finally:
+        del connection.rollback
+
+
+@contextmanager
+def request_scope():
+    previous = get_memo()
+    _local.memo = {}
+    try:
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(clear_on_write))
+                stack.enter_context(clear_on_rollback(connection))
+            yield _local.memo
+    finally:
+        _local.memo = previous
+
+
+def request_memoized(method):
+    """
+    Decorator to cache result of model method until the end of the
+    request or the next write to database. Instances of the same row
+    share results, so the method must depend on saved data only.
+    Outside of requests the method is always called.
+    """
+    @wraps(method)
+    def wrapper(self, *args):
+        memo = get_memo()
+        if memo is None or self.pk is None:
+            return method(self, *args)
+
+        key = (self._meta.label, self.pk, method.__name__) + args
+        try:
+            return memo[key]
+        except KeyError:
+            value = memo[key] = method(self, *args)
+            return value
+
+    return wrapper
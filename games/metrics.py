@@ -0,0 +1,288 @@
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from django.conf import settings
+from django.db import connections
+from django_redis.cache import RedisCache
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess,
+                               start_http_server)
+from redis import Redis
+from redis.client import Pipeline
+
+
+logger = logging.getLogger(__name__)
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+
+REQUEST_LATENCY = Histogram(
+    'games_request_latency_seconds', 'Latency of requests', ['view'])
+REQUEST_QUERIES = Histogram(
+    'games_request_queries', 'SQL queries per request', ['view'],
+    buckets=COUNT_BUCKETS)
+REQUEST_DATABASE_TIME = Histogram(
+    'games_request_database_seconds', 'Database time per request', ['view'])
+REQUEST_CACHE_HITS = Histogram(
+    'games_request_cache_hits', 'Cache hits per request', ['view'],
+    buckets=COUNT_BUCKETS)
+REQUEST_CACHE_MISSES = Histogram(
+    'games_request_cache_misses', 'Cache misses per request', ['view'],
+    buckets=COUNT_BUCKETS)
+REQUEST_REDIS_CALLS = Histogram(
+    'games_request_redis_calls', 'Redis calls per request', ['view'],
+    buckets=COUNT_BUCKETS)
+
+TASK_RUNTIME = Histogram(
+    'games_task_runtime_seconds', 'Runtime of Celery tasks', ['task'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+TASK_QUEUE_WAIT = Histogram(
+    'games_task_queue_wait_seconds',
+    'Time Celery tasks waited in queue since they were due', ['task'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+TASK_QUERIES = Histogram(
+    'games_task_queries', 'SQL queries per Celery task', ['task'],
+    buckets=COUNT_BUCKETS + (1000, 5000))
+TASK_FAILURES = Counter(
+    'games_task_failures', 'Failed Celery tasks', ['task', 'exception'])
+TASK_RETRIES = Counter(
+    'games_task_retries', 'Retried Celery tasks', ['task'])
+
+# Header with time the task was sent at
+PUBLISHED_AT_HEADER = 'published_at'
+
+# Recorder of the request or task handled by current thread
+_local = threading.local()
+# Recorders and start times of running tasks by task id
+_tasks = {}
+
+
+def get_recorder():
+    return getattr(_local, 'recorder', None)
+
+
+class RequestRecorder(object):
+    """
+    Count queries, database time, cache hits and misses and Redis calls
+    of a request. SQL of queries is kept only when 'record_sql' is set.
+    Used as execute wrapper of database connections.
+    """
+
+    def __init__(self, record_sql=False):
+        self.queries = 0
+        self.database_time = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.redis_calls = 0
+        self.statements = [] if record_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.queries += 1
+            self.database_time += duration
+            if self.statements is not None:
+                self.statements.append((duration, sql))
+
+    def top_queries(self, number):
+        return sorted(self.statements, key=lambda statement: statement[0],
+                      reverse=True)[:number]
+
+
+@contextmanager
+def use_recorder(recorder):
+    previous = get_recorder()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+@contextmanager
+def record_request(record_sql=False):
+    # Eager tasks are recorded inside of the request sending them
+    with use_recorder(RequestRecorder(record_sql)) as recorder, \
+            ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+def bind_recorder(func):
+    """
+    Return function counting into recorder of the current request
+    also when it is called by another thread, e.g. of a thread pool.
+    """
+    recorder = get_recorder()
+
+    def wrapper(*args, **kwargs):
+        with use_recorder(recorder):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def sample_slow_request():
+    """
+    Decide whether SQL of the request is recorded for the slow request
+    log. Recording every statement is not free, so only a share of
+    requests is sampled.
+    """
+    return random.random() < settings.METRICS_SLOW_REQUEST_SAMPLE_RATE
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else '<unresolved>'
+
+
+def observe_request(request, recorder, latency):
+    view = get_view_name(request)
+    REQUEST_LATENCY.labels(view).observe(latency)
+    REQUEST_QUERIES.labels(view).observe(recorder.queries)
+    REQUEST_DATABASE_TIME.labels(view).observe(recorder.database_time)
+    REQUEST_CACHE_HITS.labels(view).observe(recorder.cache_hits)
+    REQUEST_CACHE_MISSES.labels(view).observe(recorder.cache_misses)
+    REQUEST_REDIS_CALLS.labels(view).observe(recorder.redis_calls)
+
+    if (recorder.statements is not None
+            and latency >= settings.METRICS_SLOW_REQUEST_THRESHOLD):
+        top_queries = recorder.top_queries(
+            settings.METRICS_SLOW_REQUEST_TOP_QUERIES)
+        logger.warning(
+            'Slow request %s %s (%s) took %.3fs: %d queries in %.3fs, '
+            '%d Redis calls\n%s',
+            request.method, request.path, view, latency, recorder.queries,
+            recorder.database_time, recorder.redis_calls,
+            '\n'.join('{0:.3f}s {1}'.format(duration, sql)
+                      for duration, sql in top_queries))
+
+
+def get_queue_wait(request, now=None):
+    """
+    Return seconds the task waited for a worker since it was sent or,
+    if it was scheduled, since its ETA. Eager tasks are not queued.
+    """
+    published_at = request.get(PUBLISHED_AT_HEADER)
+    if published_at is None:
+        return None
+    due = published_at
+    if request.get('eta'):
+        due = max(due, datetime.fromisoformat(request.eta).timestamp())
+    return max(0, (now or time.time()) - due)
+
+
+def start_task(task):
+    queue_wait = get_queue_wait(task.request)
+    if queue_wait is not None:
+        TASK_QUEUE_WAIT.labels(task.name).observe(queue_wait)
+
+    stack = ExitStack()
+    recorder = stack.enter_context(record_request())
+    _tasks[task.request.id] = (stack, recorder, time.perf_counter())
+
+
+def finish_task(task, task_id):
+    try:
+        stack, recorder, start = _tasks.pop(task_id)
+    except KeyError:
+        return
+    stack.close()
+    TASK_RUNTIME.labels(task.name).observe(time.perf_counter() - start)
+    TASK_QUERIES.labels(task.name).observe(recorder.queries)
+
+
+def get_registry():
+    """
+    Gunicorn workers and Celery pool processes write metrics to
+    'prometheus_multiproc_dir', when it is set, and they are summed
+    up on collection.
+    """
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def generate_metrics():
+    """
+    Return metrics in Prometheus text format and its content type.
+    """
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def start_worker_server(port):
+    """
+    Expose metrics of Celery worker and its pool processes on port.
+    """
+    if 'prometheus_multiproc_dir' in os.environ:
+        os.makedirs(os.environ['prometheus_multiproc_dir'], exist_ok=True)
+    start_http_server(port, registry=get_registry())
+
+
+# Backends enabled in settings when METRICS_ENABLED is set
+
+class InstrumentedRedisCache(RedisCache):
+    """
+    Redis cache counting hits and misses of the current request.
+    """
+    missing = object()
+
+    def get(self, key, default=None, version=None, client=None):
+        value = super().get(key, self.missing, version=version,
+                            client=client)
+        recorder = get_recorder()
+        if recorder:
+            if value is self.missing:
+                recorder.cache_misses += 1
+            else:
+                recorder.cache_hits += 1
+        return default if value is self.missing else value
+
+    def get_many(self, keys, version=None, client=None):
+        keys = list(keys)
+        values = super().get_many(keys, version=version, client=client)
+        recorder = get_recorder()
+        if recorder:
+            recorder.cache_hits += len(values)
+            recorder.cache_misses += len(keys) - len(values)
+        return values
+
+
+class InstrumentedPipeline(Pipeline):
+    """
+    Pipeline sent to Redis at once is counted as a single call.
+    """
+
+    def execute(self, raise_on_error=True):
+        recorder = get_recorder()
+        if recorder:
+            recorder.redis_calls += 1
+        return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Redis client counting calls of the current request, used by caches
+    and by recommender through their connection pools. Calls made in
+    other threads are counted only when bound with 'bind_recorder'.
+    """
+
+    def execute_command(self, *args, **options):
+        recorder = get_recorder()
+        if recorder:
+            recorder.redis_calls += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks,
+                                    transaction, shard_hint)
@@ -1,4 +1,5 @@
-from . import models
+import time
+from . import memoize, metrics, models, profiling
 
 
 def cart_middleware(get_response):
@@ -16,3 +17,52 @@ def cart_middleware(get_response):
         return response
 
     return middleware
+
+
+def memoize_middleware(get_response):
+    """
+    Keep results of methods decorated with 'request_memoized' for the
+    duration of the request.
+    """
+
+    def middleware(request):
+        with memoize.request_scope():
+            response = get_response(request)
+        return response
+
+    return middleware
+
+
+def metrics_middleware(get_response):
+    """
+    Record queries, database time, cache hits and misses, Redis calls
+    and latency of every request per URL name, enabled with
+    METRICS_ENABLED setting. Sampled requests slower than
+    METRICS_SLOW_REQUEST_THRESHOLD are logged with their top queries.
+    """
+
+    def middleware(request):
+        start = time.perf_counter()
+        with metrics.record_request(
+                metrics.sample_slow_request()) as recorder:
+            response = get_response(request)
+        metrics.observe_request(request, recorder,
+                                time.perf_counter() - start)
+        return response
+
+    return middleware
+
+
+def query_profiling_middleware(get_response):
+    """
+    Log queries slower than QUERY_PROFILING_THRESHOLD with the URL name
+    of the view issuing them, enabled with QUERY_PROFILING_ENABLED.
+    """
+
+    def middleware(request):
+        with profiling.profile_queries(
+                lambda: metrics.get_view_name(request)):
+            response = get_response(request)
+        return response
+
+    return middleware
@@ -0,0 +1,71 @@
+# Generated by Django 3.0.10 on 2026-10-19 17:42
+
+from django.db import migrations, models
+
+
+SLUG_LENGTH = 48
+
+
+def get_free_slug(model, slug, number):
+    while True:
+        suffix = '-{}'.format(number)
+        new_slug = slug[:SLUG_LENGTH - len(suffix)] + suffix
+        if not model.objects.filter(slug=new_slug).exists():
+            return new_slug
+        number += 1
+
+
+def dedupe_slugs(apps, schema_editor):
+    # Slugs become unique, the oldest object keeps a duplicated slug
+    # and the others get their id appended
+    for model_name in ('Product', 'ProductTag'):
+        model = apps.get_model('games', model_name)
+        duplicated = (model.objects.values('slug')
+                      .annotate(count=models.Count('id'))
+                      .filter(count__gt=1)
+                      .values_list('slug', flat=True))
+        for slug in list(duplicated):
+            for obj in model.objects.filter(slug=slug).order_by('id')[1:]:
+                obj.slug = get_free_slug(model, slug, obj.id)
+                obj.save(update_fields=['slug'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_slugs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='slug',
+            field=models.SlugField(max_length=48, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='producttag',
+            name='slug',
+            field=models.SlugField(max_length=48, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(is_default=True), fields=['user', 'address_type'], name='address_user_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status'], name='order_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(status=10), fields=['user'], name='order_user_new_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'date_added'], name='order_status_date_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(in_stock=True), fields=['name'], name='product_in_stock_name_idx'),
+        ),
+    ]
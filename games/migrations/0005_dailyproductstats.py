@@ -0,0 +1,29 @@
+# Generated by Django 3.0.10 on 2026-10-19 17:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0004_dailyorderstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyProductStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('line_num', models.PositiveIntegerField(default=0)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='games.Product')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily product stats',
+                'unique_together': {('day', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.10 on 2026-10-19 17:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0005_dailyproductstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderline',
+            name='total_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='orderline',
+            name='unit_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=6, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.0.10 on 2026-10-19 17:59
+
+from django.db import migrations, models
+
+
+# Order.PAID and Order.DONE, historical models have no constants
+PAID_STATUSES = (20, 30)
+
+
+def mark_existing_orders_confirmed(apps, schema_editor):
+    # Orders paid before this migration were confirmed by order_created,
+    # new ones are confirmed once they are paid
+    Order = apps.get_model('games', 'Order')
+    Order.objects.filter(status__in=PAID_STATUSES).update(
+        confirmation_sent=models.F('date_updated'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0006_orderline_price_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='confirmation_sent',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_existing_orders_confirmed,
+                             migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(confirmation_sent__isnull=True), fields=['id'], name='order_confirmation_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.10 on 2026-10-19 18:45
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0007_order_confirmation_sent'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='order',
+            name='order_user_new_idx',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.10 on 2026-10-19 18:48
+
+from django.db import migrations, models
+
+
+# Order.PAID and Order.DONE, historical models have no constants
+PAID_STATUSES = (20, 30)
+
+
+def mark_existing_orders_added(apps, schema_editor):
+    # Orders paid before this migration were added to statistics by
+    # order_created or by their rebuild
+    Order = apps.get_model('games', 'Order')
+    Order.objects.filter(status__in=PAID_STATUSES).update(
+        stats_added=models.F('date_updated'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0008_remove_order_user_new_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='stats_added',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_existing_orders_added,
+                             migrations.RunPython.noop),
+    ]
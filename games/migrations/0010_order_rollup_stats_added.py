@@ -0,0 +1,30 @@
+# Generated by Django 3.0.10 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+def copy_stats_added(apps, schema_editor):
+    # Both statistics were added by order_created together so far
+    Order = apps.get_model('games', 'Order')
+    Order.objects.update(product_stats_added=models.F('order_stats_added'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0009_order_stats_added'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='order',
+            old_name='stats_added',
+            new_name='order_stats_added',
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='product_stats_added',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(copy_stats_added, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 3.0.10 on 2026-10-19 19:40
+
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+
+# Order.PAID and Order.DONE, historical models have no constants
+PAID_STATUSES = (20, 30)
+BATCH_SIZE = 1000
+
+
+def rebuild_daily_stats(apps, schema_editor):
+    # Rollups are recomputed over the whole order history, together
+    # with the flags of orders they count, as reconcile tasks rebuild
+    # only the last days
+    Order = apps.get_model('games', 'Order')
+    OrderLine = apps.get_model('games', 'OrderLine')
+    DailyOrderStats = apps.get_model('games', 'DailyOrderStats')
+    DailyProductStats = apps.get_model('games', 'DailyProductStats')
+
+    orders = Order.objects.filter(status__in=PAID_STATUSES)
+    now = timezone.now()
+    orders.update(order_stats_added=now, product_stats_added=now)
+
+    data = (orders.filter(payment__isnull=False)
+            .values('payment__date_paid')
+            .annotate(order_num=models.Count('id'),
+                      revenue=models.Sum('payment__amount')))
+    DailyOrderStats.objects.all().delete()
+    DailyOrderStats.objects.bulk_create(
+        [DailyOrderStats(day=x['payment__date_paid'],
+                         order_num=x['order_num'],
+                         revenue=x['revenue']) for x in data],
+        batch_size=BATCH_SIZE)
+
+    data = (OrderLine.objects.filter(order__in=orders)
+            .annotate(day=TruncDate('order__date_added'))
+            .values('day', 'product_id')
+            .annotate(line_num=models.Count('id'),
+                      total_quantity=models.Sum('quantity'),
+                      revenue=models.Sum('total_price')))
+    DailyProductStats.objects.all().delete()
+    DailyProductStats.objects.bulk_create(
+        [DailyProductStats(day=x['day'],
+                           product_id=x['product_id'],
+                           line_num=x['line_num'],
+                           quantity=x['total_quantity'],
+                           revenue=x['revenue'] or 0) for x in data],
+        batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0010_order_rollup_stats_added'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_daily_stats, migrations.RunPython.noop),
+    ]
@@ -1,8 +1,11 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, TruncDate
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.urls import reverse
+from django.utils import timezone
 from django_countries.fields import CountryField
+from .memoize import request_memoized
 
 
 class CustomUserManager(BaseUserManager):
@@ -73,7 +76,7 @@ class ProductTagManager(models.Manager):
 
 class ProductTag(models.Model):
     name = models.CharField(max_length=32)
-    slug = models.SlugField(max_length=48)
+    slug = models.SlugField(max_length=48, unique=True)
     active = models.BooleanField(default=True)
 
     objects = ProductTagManager()
@@ -97,13 +100,21 @@ class Product(models.Model):
         max_digits=6, decimal_places=2)
     discount_price = models.DecimalField(
         max_digits=6, decimal_places=2, blank=True, null=True)
-    slug = models.SlugField(max_length=48)
+    slug = models.SlugField(max_length=48, unique=True)
     in_stock = models.BooleanField(default=True)
     date_updated = models.DateTimeField(auto_now=True)
     tags = models.ManyToManyField('ProductTag', blank=True)
 
     objects = InStockManager()
 
+    class Meta:
+        indexes = [
+            # Home page lists in stock products ordered by name
+            models.Index(fields=['name'],
+                         name='product_in_stock_name_idx',
+                         condition=models.Q(in_stock=True)),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -148,6 +159,12 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            # Lookup of user's default address on checkout
+            models.Index(fields=['user', 'address_type'],
+                         name='address_user_default_idx',
+                         condition=models.Q(is_default=True)),
+        ]
 
     def __str__(self):
         return self.street_address
@@ -167,15 +184,27 @@ class Cart(models.Model):
     coupon = models.ForeignKey(
         'Coupon', on_delete=models.SET_NULL, blank=True, null=True)
 
+    @request_memoized
     def is_empty(self):
         return self.lines.all().count() == 0
 
+    @request_memoized
     def count(self):
         return sum(i.quantity for i in self.lines.all())
 
+    def get_lines(self):
+        # Lines prefetched with their products are reused
+        if 'lines' in getattr(self, '_prefetched_objects_cache', {}):
+            return self.lines.all()
+        return self.lines.select_related('product')
+
+    @request_memoized
     def get_total(self):
+        return self.get_lines_total(self.get_lines())
+
+    def get_lines_total(self, lines):
         total = 0
-        for cart_line in self.lines.all():
+        for cart_line in lines:
             total += cart_line.get_total_product_price()
         if self.coupon:
             total -= self.coupon.amount
@@ -199,20 +228,35 @@ class Cart(models.Model):
         )
         return order
 
-    def submit(self):
-        order = Order.objects.filter(
-            user=self.user, status=Order.NEW).first()
-        orderlines = []
-        for line in self.lines.select_related('product'):
-            orderlines.append(
-                OrderLine(
-                    order=order,
-                    product=line.product,
-                    quantity=line.quantity
-                )
-            )
-        OrderLine.objects.bulk_create(orderlines)
-
+    @transaction.atomic
+    def pay(self):
+        """
+        Pay for cart's products with a constant number of queries:
+        create payment, move products to user's new order and delete
+        the cart. Cart and order rows are locked, so concurrent
+        payments for the same cart create a single payment.
+        Return paid order or None if there is nothing to pay for.
+        """
+        cart = (Cart.objects.select_for_update(of=('self',))
+                .select_related('coupon').filter(pk=self.pk).first())
+        if cart is None:
+            return None
+        order = (Order.objects.select_for_update()
+                 .filter(user=cart.user, status=Order.NEW).first())
+        if order is None:
+            return None
+
+        # Prices are read once and used for both payment and lines
+        lines = list(cart.lines.select_related('product'))
+        payment = Payment.objects.create(
+            user=cart.user, amount=cart.get_lines_total(lines))
+        OrderLine.objects.bulk_create(
+            [line.make_order_line(order) for line in lines])
+
+        order.payment = payment
+        order.status = Order.PAID
+        order.save(update_fields=['payment', 'status', 'date_updated'])
+        cart.delete()
         return order
 
 
@@ -223,9 +267,42 @@ class CartLine(models.Model):
         'Product', on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    def get_product_price(self):
+        return self.product.discount_price or self.product.price
+
     def get_total_product_price(self):
-        price = self.product.discount_price or self.product.price
-        return price * self.quantity
+        return self.get_product_price() * self.quantity
+
+    def make_order_line(self, order):
+        """
+        Return unsaved order line with snapshot of product's current price.
+        """
+        price = self.get_product_price()
+        return OrderLine(order=order, product=self.product,
+                         quantity=self.quantity, unit_price=price,
+                         total_price=price * self.quantity)
+
+
+class OrderManager(models.Manager):
+
+    def mark_done_if_processed(self, order_ids):
+        """
+        Set status 'Done' to orders which have no processing lines left
+        with a single conditional UPDATE.
+        """
+        processing_lines = OrderLine.objects.filter(
+            order=models.OuterRef('pk'), status=OrderLine.PROCESSING)
+        return (self.filter(pk__in=order_ids)
+                .exclude(status=Order.DONE)
+                .filter(~models.Exists(processing_lines))
+                .update(status=Order.DONE, date_updated=timezone.now()))
+
+    def pending_confirmation(self):
+        """
+        Return paid orders whose confirmation e-mail was not sent yet.
+        """
+        return self.filter(status__in=(Order.PAID, Order.DONE),
+                           confirmation_sent__isnull=True)
 
 
 class Order(models.Model):
@@ -249,10 +326,73 @@ class Order(models.Model):
     )
     payment = models.ForeignKey(
         'Payment', on_delete=models.SET_NULL, blank=True, null=True)
+    confirmation_sent = models.DateTimeField(blank=True, null=True)
+    # Orders are added to daily statistics once, see DailyStatsManager
+    order_stats_added = models.DateTimeField(blank=True, null=True)
+    product_stats_added = models.DateTimeField(blank=True, null=True)
 
     date_updated = models.DateTimeField(auto_now=True)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    objects = OrderManager()
+
+    class Meta:
+        indexes = [
+            # Lookup of user's open order on checkout and payment
+            models.Index(fields=['user', 'status'],
+                         name='order_user_status_idx'),
+            # Filtering by status and date in API and analytics
+            models.Index(fields=['status', 'date_added'],
+                         name='order_status_date_added_idx'),
+            # Lookup of orders waiting for confirmation e-mail
+            models.Index(fields=['id'],
+                         name='order_confirmation_pending_idx',
+                         condition=models.Q(confirmation_sent__isnull=True)),
+        ]
+
+
+class OrderLineManager(models.Manager):
+
+    def update_statuses(self, statuses):
+        """
+        Set statuses of many lines at once ({line id: status}) and
+        complete their orders in constant number of queries.
+        """
+        whens = [models.When(pk=pk, then=models.Value(status))
+                 for pk, status in statuses.items()]
+        lines = self.filter(pk__in=list(statuses))
+        with transaction.atomic():
+            updated = lines.update(status=models.Case(
+                *whens, output_field=models.IntegerField()))
+            Order.objects.mark_done_if_processed(lines.values('order_id'))
+        return updated
+
+    def backfill_prices(self, batch_size=1000):
+        """
+        Fill in price snapshot of lines created before prices were
+        stored, using current price of product. Lines are updated
+        in batches to keep transactions short.
+        Return number of updated lines.
+        """
+        products = Product.objects.filter(pk=models.OuterRef('product'))
+        unit_price = models.Subquery(products.values(
+            current_price=Coalesce('discount_price', 'price'))[:1])
+        total_price = models.ExpressionWrapper(
+            unit_price * models.F('quantity'),
+            output_field=models.DecimalField(max_digits=8,
+                                             decimal_places=2))
+        missing = self.filter(unit_price__isnull=True).order_by('pk')
+
+        updated, last_id = 0, 0
+        while True:
+            ids = list(missing.filter(pk__gt=last_id)
+                       .values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return updated
+            updated += self.filter(pk__in=ids).update(
+                unit_price=unit_price, total_price=total_price)
+            last_id = ids[-1]
+
 
 class OrderLine(models.Model):
     PROCESSING = 10
@@ -272,6 +412,13 @@ class OrderLine(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     status = models.IntegerField(
         choices=STATUSES, default=PROCESSING)
+    # Snapshot of product's price at the moment of purchase
+    unit_price = models.DecimalField(
+        max_digits=6, decimal_places=2, blank=True, null=True)
+    total_price = models.DecimalField(
+        max_digits=8, decimal_places=2, blank=True, null=True)
+
+    objects = OrderLineManager()
 
 
 class Payment(models.Model):
@@ -287,6 +434,188 @@ class Payment(models.Model):
         # return '{0}, {1}'.format(self.method, self.amount)
 
 
+class DailyStatsManager(models.Manager):
+    """
+    Daily statistics updated by each paid order once. Field 'order_flag'
+    of Order marks orders already added to them.
+    """
+    order_flag = None
+
+    def mark_added(self, order):
+        """
+        Mark order as added. Return False if it already was, e.g. by
+        a retried task or by rebuild.
+        """
+        return bool(Order.objects.filter(
+            pk=order.pk, **{self.order_flag + '__isnull': True})
+            .update(**{self.order_flag: timezone.now()}))
+
+    def mark_counted(self, orders):
+        """
+        Mark paid orders as added before statistics are rebuilt, so
+        'order_created' of orders still waiting in queue doesn't add
+        them again. Orders whose task is running are counted once it
+        commits. Return orders to count.
+        """
+        orders.filter(**{self.order_flag + '__isnull': True}).update(
+            **{self.order_flag: timezone.now()})
+        return orders.filter(**{self.order_flag + '__isnull': False})
+
+
+class DailyOrderStatsManager(DailyStatsManager):
+    order_flag = 'order_stats_added'
+
+    def add_order(self, order):
+        """
+        Add paid order to statistics of the day it was paid, unless
+        it was added already. Return whether it was added.
+        """
+        with transaction.atomic():
+            if not self.mark_added(order):
+                return False
+            day = order.payment.date_paid
+            # Row deleted by concurrent 'rebuild' is created again
+            while not self.filter(day=day).update(
+                    order_num=models.F('order_num') + 1,
+                    revenue=models.F('revenue') + order.payment.amount):
+                self.get_or_create(day=day)
+        return True
+
+    def rebuild(self, from_day, to_day=None):
+        """
+        Recompute statistics of days in range from paid orders.
+        """
+        orders = Order.objects.filter(
+            status__in=(Order.PAID, Order.DONE),
+            payment__date_paid__gte=from_day)
+        days = self.filter(day__gte=from_day)
+        if to_day:
+            orders = orders.filter(payment__date_paid__lte=to_day)
+            days = days.filter(day__lte=to_day)
+
+        with transaction.atomic():
+            orders = self.mark_counted(orders)
+            # Rows are locked until they are replaced, so increments
+            # made meanwhile are applied to the new ones
+            list(days.select_for_update())
+            data = (orders.values('payment__date_paid')
+                    .annotate(order_num=models.Count('id'),
+                              revenue=models.Sum('payment__amount')))
+            stats = [self.model(day=x['payment__date_paid'],
+                                order_num=x['order_num'],
+                                revenue=x['revenue']) for x in data]
+            days.delete()
+            self.bulk_create(stats)
+        return len(stats)
+
+
+class DailyOrderStats(models.Model):
+    """
+    Number of paid orders and revenue per day, precomputed
+    for analytics.
+    """
+    day = models.DateField(unique=True)
+    order_num = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = DailyOrderStatsManager()
+
+    class Meta:
+        verbose_name_plural = 'Daily order stats'
+
+    def __str__(self):
+        return '{0}, {1}'.format(self.day, self.order_num)
+
+
+class DailyProductStatsManager(DailyStatsManager):
+    order_flag = 'product_stats_added'
+
+    def add_order(self, order):
+        """
+        Add lines of paid order to statistics of the day the order
+        was placed, unless it was added already. Return whether it
+        was added.
+        """
+        day = timezone.localdate(order.date_added)
+        totals = {}
+        for line in order.lines.all():
+            line_num, quantity, revenue = totals.get(line.product_id,
+                                                     (0, 0, 0))
+            totals[line.product_id] = (line_num + 1,
+                                       quantity + line.quantity,
+                                       revenue + (line.total_price or 0))
+
+        with transaction.atomic():
+            if not self.mark_added(order):
+                return False
+            for product_id, (line_num, quantity, revenue) in totals.items():
+                # Row deleted by concurrent 'rebuild' is created again
+                while not self.filter(
+                        day=day, product_id=product_id).update(
+                        line_num=models.F('line_num') + line_num,
+                        quantity=models.F('quantity') + quantity,
+                        revenue=models.F('revenue') + revenue):
+                    self.get_or_create(day=day, product_id=product_id)
+        return True
+
+    def rebuild(self, from_day, to_day=None):
+        """
+        Recompute statistics of days in range from lines of paid orders.
+        """
+        orders = Order.objects.filter(
+            status__in=(Order.PAID, Order.DONE),
+            date_added__date__gte=from_day)
+        days = self.filter(day__gte=from_day)
+        if to_day:
+            orders = orders.filter(date_added__date__lte=to_day)
+            days = days.filter(day__lte=to_day)
+
+        with transaction.atomic():
+            orders = self.mark_counted(orders)
+            # Rows are locked until they are replaced, so increments
+            # made meanwhile are applied to the new ones
+            list(days.select_for_update())
+            lines = OrderLine.objects.filter(order__in=orders)
+            data = (lines.annotate(day=TruncDate('order__date_added'))
+                    .values('day', 'product_id')
+                    .annotate(line_num=models.Count('id'),
+                              total_quantity=models.Sum('quantity'),
+                              revenue=models.Sum('total_price')))
+            stats = [self.model(day=x['day'],
+                                product_id=x['product_id'],
+                                line_num=x['line_num'],
+                                quantity=x['total_quantity'],
+                                revenue=x['revenue'] or 0) for x in data]
+            days.delete()
+            self.bulk_create(stats)
+        return len(stats)
+
+
+class DailyProductStats(models.Model):
+    """
+    Number of order lines, bought quantity and revenue of product
+    per day, precomputed for analytics.
+    """
+    day = models.DateField()
+    product = models.ForeignKey(
+        'Product', on_delete=models.CASCADE)
+    line_num = models.PositiveIntegerField(default=0)
+    quantity = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(
+        max_digits=12, decimal_places=2, default=0)
+
+    objects = DailyProductStatsManager()
+
+    class Meta:
+        verbose_name_plural = 'Daily product stats'
+        unique_together = ('day', 'product')
+
+    def __str__(self):
+        return '{0}, {1}'.format(self.day, self.product_id)
+
+
 class Coupon(models.Model):
     code = models.CharField(max_length=20)
     amount = models.DecimalField(max_digits=6, decimal_places=2)
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import random
+import re
+import time
+import traceback
+from contextlib import ExitStack, contextmanager
+from logging.handlers import RotatingFileHandler
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames of these modules wrap queries, they don't issue them
+IGNORED_MODULES = ('profiling.py', 'metrics.py')
+# SELECT ... FOR UPDATE / FOR SHARE and their variants
+LOCKING_CLAUSE = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b', re.IGNORECASE)
+
+# Slow queries are written as JSON lines, see 'read_slow_queries'
+slow_query_logger = logging.getLogger(__name__ + '.slow_queries')
+slow_query_logger.propagate = False
+slow_query_logger.setLevel(logging.INFO)
+
+# Profilers of running tasks by task id
+_tasks = {}
+
+
+def get_slow_query_logger():
+    path = os.path.abspath(settings.QUERY_PROFILING_LOG)
+    for handler in slow_query_logger.handlers:
+        if handler.baseFilename == path:
+            return slow_query_logger
+        slow_query_logger.removeHandler(handler)
+        handler.close()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handler = RotatingFileHandler(
+        path, maxBytes=settings.QUERY_PROFILING_LOG_MAX_BYTES,
+        backupCount=settings.QUERY_PROFILING_LOG_BACKUP_COUNT, delay=True)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    slow_query_logger.addHandler(handler)
+    return slow_query_logger
+
+
+def get_location():
+    """
+    Return file, line and function of games/ issuing the query.
+    """
+    for frame in reversed(traceback.extract_stack()):
+        if (frame.filename.startswith(APP_DIR) and
+                os.path.basename(frame.filename) not in IGNORED_MODULES):
+            return '{0}:{1} in {2}'.format(
+                os.path.relpath(frame.filename, os.path.dirname(APP_DIR)),
+                frame.lineno, frame.name)
+    return None
+
+
+def explain(connection, sql, params, analyze=False):
+    """
+    Return plan of PostgreSQL SELECT query. With 'analyze' the query is
+    run again for actual timing and buffers, so queries locking rows
+    are never explained.
+    """
+    if (connection.vendor != 'postgresql'
+            or not sql.lstrip().upper().startswith('SELECT')
+            or LOCKING_CLAUSE.search(sql)):
+        return None
+
+    # Cursor of the driver, so the plan isn't profiled or counted itself
+    with connection.connection.cursor() as cursor:
+        # Failed EXPLAIN must not abort transaction of the request
+        savepoint = connection.in_atomic_block
+        if savepoint:
+            cursor.execute('SAVEPOINT query_profiler')
+        try:
+            cursor.execute(
+                ('EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN ')
+                + sql, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except connection.Database.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_profiler')
+            return 'EXPLAIN failed: {}'.format(e)
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT query_profiler')
+    return plan
+
+
+class SlowQueryProfiler(object):
+    """
+    Execute wrapper logging queries slower than
+    QUERY_PROFILING_THRESHOLD with the view or task and the line
+    issuing them. A sample of them is logged with EXPLAIN plan, a
+    smaller one with EXPLAIN ANALYZE which runs the query again.
+    """
+
+    def __init__(self, get_source):
+        self.get_source = get_source
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = time.perf_counter() - start
+        if duration >= settings.QUERY_PROFILING_THRESHOLD:
+            self.log(sql, params, many, context['connection'], duration)
+        return result
+
+    def should_explain(self, source):
+        if source in settings.QUERY_PROFILING_ALWAYS_EXPLAIN:
+            return True
+        return random.random() < settings.QUERY_PROFILING_EXPLAIN_SAMPLE_RATE
+
+    def should_analyze(self):
+        return random.random() < settings.QUERY_PROFILING_ANALYZE_SAMPLE_RATE
+
+    def log(self, sql, params, many, connection, duration):
+        source = self.get_source()
+        entry = {
+            'time': timezone.now().isoformat(),
+            'source': source,
+            'duration': round(duration, 4),
+            'location': get_location(),
+            'sql': sql,
+            'plan': None,
+        }
+        if not many and self.should_explain(source):
+            entry['plan'] = explain(connection, sql, params,
+                                    analyze=self.should_analyze())
+        get_slow_query_logger().info(json.dumps(entry))
+
+
+@contextmanager
+def profile_queries(get_source):
+    profiler = SlowQueryProfiler(get_source)
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(profiler))
+        yield profiler
+
+
+def start_task(task):
+    stack = ExitStack()
+    stack.enter_context(profile_queries(lambda: task.name))
+    _tasks[task.request.id] = stack
+
+
+def finish_task(task_id):
+    stack = _tasks.pop(task_id, None)
+    if stack is not None:
+        stack.close()
+
+
+def read_slow_queries(limit=100):
+    """
+    Return the latest logged slow queries, newest first.
+    """
+    path = settings.QUERY_PROFILING_LOG
+    paths = [path] + ['{0}.{1}'.format(path, number) for number in range(
+        1, settings.QUERY_PROFILING_LOG_BACKUP_COUNT + 1)]
+    entries = []
+    for path in paths:
+        try:
+            with open(path) as log_file:
+                lines = log_file.readlines()
+        except FileNotFoundError:
+            break
+        for line in reversed(lines):
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # line being written by another process
+                continue
+        if len(entries) >= limit:
+            break
+    return entries[:limit]
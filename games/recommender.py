@@ -1,32 +1,127 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 import redis
 from django.conf import settings
-from . import models
+from django_redis import get_redis_connection
+from . import metrics, models
 
 
-r = redis.Redis(host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                db=settings.REDIS_DB)
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a failing service for 'recovery_timeout' seconds
+    after 'failure_threshold' consecutive failures. Then a single
+    call is let through to test if it recovered.
+    """
+
+    def __init__(self, failure_threshold=3, recovery_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def is_open(self):
+        if self.opened_at is None:
+            return False
+        if time.monotonic() - self.opened_at < self.recovery_timeout:
+            return True
+        # half-open: next failure opens the circuit again
+        self.opened_at = None
+        self.failures = self.failure_threshold - 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+# Shared by all recommenders of the process
+breaker = CircuitBreaker(settings.RECOMMENDER_FAILURE_THRESHOLD,
+                         settings.RECOMMENDER_RECOVERY_TIMEOUT)
+# Threads are started on first use, so forked workers don't share them
+executor = ThreadPoolExecutor(max_workers=settings.RECOMMENDER_THREADS,
+                              thread_name_prefix='recommender')
 
 
 class Recommender(object):
+    """
+    Recommend products bought together. Recommendations are best
+    effort: when Redis is slow or down they are skipped instead of
+    failing the page or task.
+    """
+
+    def get_redis(self):
+        # Connection pool is created on first use and shared with
+        # the cache of the same Redis database
+        return get_redis_connection(settings.RECOMMENDER_CACHE_ALIAS)
 
     def get_product_key(self, id):
         return 'product:{}:purchased_with'.format(id)
 
     def products_bought(self, products):
         product_ids = [p.id for p in products]
-        for product_id in product_ids:
-            for with_id in product_ids:
-                # get the other products bought with each product
-                if product_id != with_id:
-                    # increment score for product purchased together
-                    r.zincrby(self.get_product_key(product_id), 1, with_id)
+        if len(product_ids) < 2:
+            return
+        if breaker.is_open():
+            logger.warning('Redis unavailable, purchase not recorded')
+            return
+        try:
+            pipe = self.get_redis().pipeline(transaction=False)
+            for product_id in product_ids:
+                for with_id in product_ids:
+                    # get the other products bought with each product
+                    if product_id != with_id:
+                        # increment score for product purchased together
+                        pipe.zincrby(
+                            self.get_product_key(product_id), 1, with_id)
+            pipe.execute()
+        except redis.RedisError:
+            breaker.record_failure()
+            logger.warning('Redis error, purchase not recorded',
+                           exc_info=True)
+        else:
+            breaker.record_success()
 
-    def suggest_products(self, product, max_results=3):
-        suggestions = r.zrange(
-            self.get_product_key(product.id), 0, -1, desc=True)[:max_results]
-        suggested_products_ids = [int(id) for id in suggestions]
+    def suggest_product_ids(self, product_id, max_results=3):
+        """
+        Return ids of products most often bought with the product.
+        """
+        if breaker.is_open():
+            return []
+        try:
+            suggestions = self.get_redis().zrange(
+                self.get_product_key(product_id), 0, max_results - 1,
+                desc=True)
+        except redis.RedisError:
+            breaker.record_failure()
+            logger.warning('Redis error, no suggestions', exc_info=True)
+            return []
+        breaker.record_success()
+        return [int(id) for id in suggestions]
+
+    def suggest_product_ids_in_background(self, product_id, max_results=3):
+        """
+        Start fetching suggestions in a background thread, so database
+        can be queried meanwhile. Return future of product ids.
+        """
+        # Redis calls of the thread are counted for the current request
+        return executor.submit(metrics.bind_recorder(
+            self.suggest_product_ids), product_id, max_results)
+
+    def get_products(self, product_ids):
         # get suggested products and sort by order of appearance
         suggested_products = list(models.Product.objects.filter(
-            id__in=suggested_products_ids).prefetch_related('images'))
+            id__in=product_ids).prefetch_related('images'))
         return suggested_products
+
+    def suggest_products(self, product, max_results=3):
+        return self.get_products(
+            self.suggest_product_ids(product.id, max_results))
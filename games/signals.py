@@ -1,12 +1,21 @@
 import logging
+import os
+import time
 from io import BytesIO
 from PIL import Image
 from django.core.files.base import ContentFile
+from prometheus_client import multiprocess
+from celery.signals import (before_task_publish, task_failure,
+                            task_postrun, task_prerun, task_retry,
+                            worker_process_shutdown, worker_ready)
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
 from django.db.models.signals import pre_save, post_save, pre_delete, m2m_changed
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
 from django.core.cache import cache
-from . import models
+from . import metrics, models, profiling
 
 
 THUMBNAIL_SIZE = (300, 300)
@@ -140,10 +149,90 @@ def product_m2m_changed_cache_clear(sender, instance, **kwargs):
 def orderline_pre_save_change_order_status(sender, instance, **kwargs):
     """Change status of order to 'Done' if it's each OrderLine processed.
     """
-    if instance.status > 10:
-        orderline = models.OrderLine.objects.select_related(
-            'order').prefetch_related('order__lines').get(pk=instance.pk)
-        order = orderline.order
-        if all(line.status > 10 for line in order.lines.all()):
-            instance.order.status = 30
-            instance.order.save()
+    if instance.status > models.OrderLine.PROCESSING:
+        updated = models.Order.objects.mark_done_if_processed(
+            [instance.order_id])
+        # Keep already loaded order in sync with database
+        if updated and models.OrderLine.order.is_cached(instance):
+            instance.order.status = models.Order.DONE
+
+
+@receiver(request_started)
+def check_database_connections(**kwargs):
+    """
+    Close persistent connections dropped by database or pgbouncer, so
+    they are reopened instead of failing the first query.
+    """
+    if not settings.DB_CONN_HEALTH_CHECKS:
+        return
+    for conn in connections.all():
+        if conn.connection is not None and not conn.is_usable():
+            conn.close()
+
+
+# Celery workers keep connections between tasks as well
+task_prerun.connect(check_database_connections)
+
+
+@before_task_publish.connect
+def stamp_task_published_at(headers=None, **kwargs):
+    """
+    Send time of publishing with the task to measure its queue wait.
+    """
+    if settings.METRICS_ENABLED and headers is not None:
+        headers[metrics.PUBLISHED_AT_HEADER] = time.time()
+
+
+@task_prerun.connect
+def start_task_metrics(task, **kwargs):
+    if settings.METRICS_ENABLED:
+        metrics.start_task(task)
+
+
+@task_postrun.connect
+def finish_task_metrics(task, task_id, **kwargs):
+    if settings.METRICS_ENABLED:
+        metrics.finish_task(task, task_id)
+
+
+@task_prerun.connect
+def start_task_query_profiling(task, **kwargs):
+    if settings.QUERY_PROFILING_ENABLED:
+        profiling.start_task(task)
+
+
+@task_postrun.connect
+def finish_task_query_profiling(task_id, **kwargs):
+    profiling.finish_task(task_id)
+
+
+@task_failure.connect
+def count_task_failure(sender, exception, **kwargs):
+    if settings.METRICS_ENABLED:
+        metrics.TASK_FAILURES.labels(
+            sender.name, type(exception).__name__).inc()
+
+
+@task_retry.connect
+def count_task_retry(sender, **kwargs):
+    if settings.METRICS_ENABLED:
+        metrics.TASK_RETRIES.labels(sender.name).inc()
+
+
+@worker_ready.connect
+def start_worker_metrics_server(**kwargs):
+    """
+    Expose task metrics of the worker for Prometheus.
+    """
+    if settings.METRICS_ENABLED and settings.METRICS_WORKER_PORT:
+        metrics.start_worker_server(settings.METRICS_WORKER_PORT)
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid, **kwargs):
+    """
+    Drop live metrics of exited pool process. Processes write metric
+    files whenever the directory is set, whether METRICS_ENABLED is.
+    """
+    if os.environ.get('prometheus_multiproc_dir'):
+        multiprocess.mark_process_dead(pid)
@@ -1,44 +1,112 @@
 from __future__ import absolute_import, unicode_literals
+import os
+import gzip
 import logging
+import secrets
 from datetime import timedelta
+from smtplib import SMTPException
 from celery import shared_task
-from django.core.mail import send_mail
+from django.apps import apps
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.urls import reverse
 from django.utils import timezone
-from django.db.models import Subquery
+from django.db.models import Prefetch, Subquery
 from django.contrib.auth import get_user_model
-from .models import Order, Cart
+from .models import (Order, OrderLine, Cart, DailyOrderStats,
+                     DailyProductStats)
 from .recommender import Recommender
+from .api.cache import invalidate_analytics_cache
 
 logger = logging.getLogger(__name__).setLevel("INFO")
 
 
 r = Recommender()
 
+EXPORT_PROGRESS_STEP = 2000
+
+CONFIRMATION_BATCH_SIZE = 500
+CONFIRMATION_KEY = 'order_confirmation:{}'
+CONFIRMATION_KEY_TIMEOUT = 60 * 60
+
 
 @shared_task
 def order_created(order_id):
     """
-    Task to send an e-mail notification when an order is
-    successfully created.
+    Task to update recommendations and statistics when an order is
+    successfully created. Confirmation e-mail is sent in a batch
+    by 'send_order_confirmations'.
     """
-    order = Order.objects.get(pk=order_id)
-    products = [line.product for line in order.lines.all()]
+    order = Order.objects.select_related('payment').get(pk=order_id)
+    products = [line.product for line in order.lines.select_related('product')]
 
     r.products_bought(products)
 
+    if not order.payment:
+        return
+    # Statistics mark the order they add, so a retried or redelivered
+    # task doesn't add it twice
+    added = DailyOrderStats.objects.add_order(order)
+    added = DailyProductStats.objects.add_order(order) or added
+    if added:
+        invalidate_analytics_cache()
+
+
+def get_confirmation_message(order, connection=None):
     subject = 'Order nr. {}'.format(order.pk)
-    message = 'You have successfully placed an order.\n \
-        + Your order ID is {}'.format(order.pk)
-    mail_sent = send_mail(
+    message = ('You have successfully placed an order.\n'
+               'Your order ID is {0}\n'
+               'Products: {1}').format(
+        order.pk, ', '.join(line.product.name for line in order.lines.all()))
+    return EmailMessage(
         subject,
         message,
         'site@games4everyone.com',
         [order.user.email],
+        connection=connection,
     )
-    return mail_sent
 
 
-@shared_task
+@shared_task(autoretry_for=(SMTPException, OSError), retry_backoff=True,
+             max_retries=3, acks_late=True)
+def send_order_confirmations(batch_size=CONFIRMATION_BATCH_SIZE):
+    """
+    Task to send confirmation e-mails of paid orders in a batch over
+    a single connection. Every order is claimed with an idempotency
+    key and marked as confirmed once its e-mail is sent, so retried
+    or concurrent tasks never send it twice.
+    """
+    lines = OrderLine.objects.select_related('product')
+    orders = (Order.objects.pending_confirmation()
+              .select_related('user')
+              .prefetch_related(Prefetch('lines', queryset=lines))
+              .order_by('pk')[:batch_size])
+    claimed = [order for order in orders
+               if cache.add(CONFIRMATION_KEY.format(order.pk), True,
+                            CONFIRMATION_KEY_TIMEOUT)]
+    if not claimed:
+        return 0
+
+    sent = []
+    try:
+        with get_connection() as connection:
+            # Messages are sent one by one to know which were delivered
+            # if the connection fails in the middle of the batch
+            for order in claimed:
+                message = get_confirmation_message(order, connection)
+                if connection.send_messages([message]):
+                    sent.append(order.pk)
+    finally:
+        Order.objects.filter(pk__in=sent).update(
+            confirmation_sent=timezone.now())
+        cache.delete_many([CONFIRMATION_KEY.format(order.pk)
+                           for order in claimed if order.pk not in sent])
+    return len(sent)
+
+
+@shared_task(rate_limit='30/m')
 def contact_us_form_filled(form_data):
     """
     Task to send an e-mail message to customer service when
@@ -58,7 +126,7 @@ def contact_us_form_filled(form_data):
     return mail_sent
 
 
-@shared_task
+@shared_task(acks_late=True)
 def delete_unactive_carts():
     """
     Delete Carts if user was logged in more than 2 weeks ago.
@@ -68,3 +136,83 @@ def delete_unactive_carts():
         last_login__lt=two_weeks_ago)
     Cart.objects.select_related('user').filter(
         user__pk__in=Subquery(users.values('pk'))).delete()
+
+
+@shared_task(acks_late=True)
+def reconcile_daily_order_stats(days=360):
+    """
+    Recompute daily order statistics of the last days from orders,
+    fixing increments missed or repeated by 'order_created'.
+    """
+    from_day = timezone.now().date() - timedelta(days=days)
+    rebuilt = DailyOrderStats.objects.rebuild(from_day)
+    invalidate_analytics_cache()
+    return rebuilt
+
+
+@shared_task(acks_late=True)
+def reconcile_daily_product_stats(days=360):
+    """
+    Recompute daily product statistics of the last days from orders,
+    fixing increments missed or repeated by 'order_created'.
+    """
+    from_day = timezone.now().date() - timedelta(days=days)
+    rebuilt = DailyProductStats.objects.rebuild(from_day)
+    invalidate_analytics_cache()
+    return rebuilt
+
+
+def get_export_url(filename):
+    return '{0}://{1}{2}'.format(
+        settings.SITE_SCHEME, Site.objects.get_current().domain,
+        reverse('myadmin:export-download', args=[filename]))
+
+
+@shared_task(bind=True, acks_late=True, rate_limit='10/m')
+def export_to_csv_file(self, model_label, user_id, pks=None, filters=None):
+    """
+    Task to write objects selected in the admin changelist, by primary
+    keys or by changelist filters, to gzip-compressed CSV file in
+    private EXPORT_ROOT and send a download link to the staff user.
+    """
+    from .admin import (new_admin, get_export_fields, get_export_queryset,
+                        iter_csv_rows)
+
+    model = apps.get_model(model_label)
+    modeladmin = new_admin._registry[model]
+    user = get_user_model().objects.get(pk=user_id)
+    lookups, headers = get_export_fields(modeladmin)
+    queryset = get_export_queryset(
+        modeladmin, user, pks, filters).order_by('pk')
+    total = queryset.count()
+
+    # Exports contain personal data, name must not be guessable
+    filename = '{0}-{1}-{2}.csv.gz'.format(
+        model._meta.model_name, timezone.now().strftime('%Y%m%d%H%M%S'),
+        secrets.token_urlsafe(16))
+    os.makedirs(settings.EXPORT_ROOT, exist_ok=True)
+
+    with gzip.open(os.path.join(settings.EXPORT_ROOT, filename), 'wt',
+                   newline='') as export_file:
+        rows = iter_csv_rows(queryset, lookups, headers)
+        # First row is the header
+        for current, row in enumerate(rows):
+            export_file.write(row)
+            if (current % EXPORT_PROGRESS_STEP == 0
+                    and not self.request.is_eager):
+                self.update_state(state='PROGRESS',
+                                  meta={'current': current,
+                                        'total': total})
+
+    url = get_export_url(filename)
+
+    subject = 'Export of {} is ready'.format(
+        model._meta.verbose_name_plural)
+    message = 'Exported {0} rows. Download file: {1}'.format(total, url)
+    send_mail(
+        subject,
+        message,
+        'site@games4everyone.com',
+        [user.email],
+    )
+    return url
@@ -19,6 +19,6 @@ def related_with_lines(cart_id):
     if not cart_id:
         return []
     cartline_qs = models.CartLine.objects.select_related('product')
-    cart = models.Cart.objects.prefetch_related(
+    cart = models.Cart.objects.select_related('coupon').prefetch_related(
         Prefetch('lines', queryset=cartline_qs)).get(pk=cart_id)
     return cart
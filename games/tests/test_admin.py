@@ -0,0 +1,181 @@
+import csv
+import json
+import os
+import tempfile
+from io import StringIO
+from django.conf import settings
+from django.db.utils import ConnectionDoesNotExist
+from django.test import TestCase, RequestFactory, override_settings
+from django.urls import reverse
+from .. import models, factories
+from unittest.mock import patch
+from ..admin import (new_admin, OrderAdmin, export_to_csv,
+                     export_to_csv_in_background, get_export_queryset)
+
+
+class TestExportToCsv(TestCase):
+
+    def setUp(self):
+        self.modeladmin = OrderAdmin(models.Order, new_admin)
+        self.request = RequestFactory().get('/')
+
+    def get_rows(self, response):
+        content = b''.join(response.streaming_content).decode()
+        return list(csv.reader(StringIO(content)))
+
+    def test_export_to_csv_streams_rows(self):
+        user = factories.UserFactory.create()
+        address = factories.AddressFactory.create(user=user)
+        order = factories.OrderFactory.create(
+            user=user, shipping_address=address)
+
+        response = export_to_csv(
+            self.modeladmin, self.request, models.Order.objects.all())
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename=order.csv')
+
+        header, row = self.get_rows(response)
+        self.assertEqual(header[:3], ['ID', 'user', 'status'])
+        self.assertEqual(row[0], str(order.pk))
+        self.assertEqual(row[1], user.email)
+        self.assertEqual(row[4], address.street_address)
+        self.assertEqual(row[5], str(order.payment.amount))
+
+    def test_export_to_csv_number_of_queries_is_constant(self):
+        factories.OrderFactory.create_batch(2)
+        queryset = models.Order.objects.all()
+
+        with self.assertNumQueries(1):
+            response = export_to_csv(self.modeladmin, self.request, queryset)
+            self.assertEqual(len(self.get_rows(response)), 3)
+
+        factories.OrderFactory.create_batch(10)
+
+        with self.assertNumQueries(1):
+            response = export_to_csv(self.modeladmin, self.request, queryset)
+            self.assertEqual(len(self.get_rows(response)), 13)
+
+    @override_settings(EXPORT_DATABASE='direct')
+    def test_export_to_csv_streams_from_export_database(self):
+        response = export_to_csv(
+            self.modeladmin, self.request, models.Order.objects.all())
+
+        with self.assertRaises(ConnectionDoesNotExist):
+            self.get_rows(response)
+
+
+@override_settings(QUERY_PROFILING_LOG=os.path.join(
+    tempfile.gettempdir(), 'games-test-slow-queries.log'))
+class TestSlowQueriesPage(TestCase):
+
+    def setUp(self):
+        with open(settings.QUERY_PROFILING_LOG, 'w') as log_file:
+            log_file.write(json.dumps({
+                'time': '2020-10-01T12:00:00+00:00', 'source': 'games:search',
+                'duration': 0.25, 'location': 'games/views.py:1 in get',
+                'sql': 'SELECT "games_product"."id"', 'plan': 'Seq Scan'}))
+        self.addCleanup(os.remove, settings.QUERY_PROFILING_LOG)
+
+    def test_staff_sees_slow_queries(self):
+        self.client.force_login(factories.UserFactory.create(is_staff=True))
+
+        response = self.client.get(reverse('myadmin:slow-queries'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'games:search')
+        self.assertContains(response, 'games/views.py:1 in get')
+        self.assertContains(response, 'Seq Scan')
+
+    def test_page_is_listed_in_reports(self):
+        self.client.force_login(factories.UserFactory.create(is_staff=True))
+
+        response = self.client.get(reverse('myadmin:index'))
+
+        self.assertContains(response, reverse('myadmin:slow-queries'))
+
+    def test_customer_is_redirected_to_login(self):
+        self.client.force_login(factories.UserFactory.create())
+
+        response = self.client.get(reverse('myadmin:slow-queries'))
+
+        self.assertEqual(response.status_code, 302)
+
+
+class TestExportToCsvInBackground(TestCase):
+
+    def setUp(self):
+        self.modeladmin = OrderAdmin(models.Order, new_admin)
+        self.user = factories.UserFactory.create(is_staff=True,
+                                                 is_superuser=True)
+
+    def export(self, request, queryset):
+        request.user = self.user
+        with patch('games.admin.export_to_csv_file.delay') as delay, \
+                patch.object(self.modeladmin, 'message_user'):
+            export_to_csv_in_background(self.modeladmin, request, queryset)
+        return delay.call_args
+
+    def test_selected_primary_keys_are_sent(self):
+        order = factories.OrderFactory.create()
+        factories.OrderFactory.create()
+        request = RequestFactory().post('/', {'select_across': '0'})
+
+        args, kwargs = self.export(
+            request, models.Order.objects.filter(pk=order.pk))
+
+        self.assertEqual(args, ('games.Order', self.user.pk))
+        self.assertEqual(kwargs, {'pks': [order.pk]})
+
+    def test_changelist_filters_are_sent_when_all_are_selected(self):
+        paid = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderFactory.create(status=models.Order.NEW)
+        filters = 'status__exact={}'.format(models.Order.PAID)
+        request = RequestFactory().post('/?' + filters,
+                                        {'select_across': '1'})
+
+        args, kwargs = self.export(
+            request, models.Order.objects.filter(pk=paid.pk))
+
+        self.assertEqual(args, ('games.Order', self.user.pk))
+        self.assertEqual(kwargs, {'filters': filters})
+        queryset = get_export_queryset(self.modeladmin, self.user, **kwargs)
+        self.assertEqual(list(queryset), [paid])
+
+
+class TestExportDownload(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(EXPORT_ROOT=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        with open(os.path.join(directory.name, 'order-1.csv.gz'), 'wb') as f:
+            f.write(b'data')
+
+    def test_staff_downloads_export(self):
+        self.client.force_login(factories.UserFactory.create(is_staff=True))
+
+        response = self.client.get(
+            reverse('myadmin:export-download', args=['order-1.csv.gz']))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'data')
+
+    def test_missing_export_is_not_found(self):
+        self.client.force_login(factories.UserFactory.create(is_staff=True))
+
+        response = self.client.get(
+            reverse('myadmin:export-download', args=['order-2.csv.gz']))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_customer_cannot_download_export(self):
+        self.client.force_login(factories.UserFactory.create())
+
+        response = self.client.get(
+            reverse('myadmin:export-download', args=['order-1.csv.gz']))
+
+        self.assertEqual(response.status_code, 302)
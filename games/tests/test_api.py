@@ -1,13 +1,17 @@
 from django.utils import timezone
-from datetime import timedelta
+from datetime import date, timedelta
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.http import urlencode
 from rest_framework import status
 from rest_framework.test import APITestCase
 from games import factories, models
+from games.api.cache import invalidate_analytics_cache
 from games.api.views import (
-    OrderList, OrderDetail, OrderLinePartialUpdate, IsUserStaff,
-    CartList)
+    OrderList, OrderDetail, OrderLinePartialUpdate, OrderLineBulkUpdate,
+    IsUserStaff, CartList)
 
 
 class TestOrder(APITestCase):
@@ -78,6 +82,182 @@ class TestOrder(APITestCase):
                          status.HTTP_403_FORBIDDEN)
 
 
+class TestOrderLineBulkUpdate(APITestCase):
+
+    def setUp(self):
+        self.staff = factories.UserFactory.create(is_staff=True)
+        self.user = factories.UserFactory.create()
+        self.product = factories.ProductFactory.create()
+        self.order1, self.order2 = factories.OrderFactory.create_batch(2)
+        self.lines1 = factories.OrderLineFactory.create_batch(
+            2, order=self.order1, product=self.product)
+        self.lines2 = factories.OrderLineFactory.create_batch(
+            2, order=self.order2, product=self.product)
+        self.url = reverse('games:{}'.format(OrderLineBulkUpdate.name))
+
+    def test_bulk_update_orderlines(self):
+        data = [{'id': line.id, 'status': models.OrderLine.SENT}
+                for line in self.lines1 + self.lines2[:1]]
+
+        self.client.force_login(self.staff)
+        patch_response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(patch_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(patch_response.data), 3)
+        self.assertTrue(all(line['status'] == models.OrderLine.SENT
+                            for line in patch_response.data))
+
+        self.order1.refresh_from_db()
+        self.order2.refresh_from_db()
+        self.assertEqual(self.order1.status, models.Order.DONE)
+        self.assertEqual(self.order2.status, models.Order.NEW)
+
+    def test_bulk_update_number_of_queries_is_constant(self):
+        self.client.force_login(self.staff)
+
+        data = [{'id': self.lines1[0].id, 'status': models.OrderLine.SENT}]
+        with CaptureQueriesContext(connection) as context:
+            self.client.patch(self.url, data, format='json')
+        queries_one_line = len(context.captured_queries)
+
+        data = [{'id': line.id, 'status': models.OrderLine.RECEIVED}
+                for line in self.lines1 + self.lines2]
+        with CaptureQueriesContext(connection) as context:
+            self.client.patch(self.url, data, format='json')
+        self.assertEqual(len(context.captured_queries), queries_one_line)
+
+    def test_bulk_update_invalid_data(self):
+        self.client.force_login(self.staff)
+
+        data = [{'id': self.lines1[0].id, 'status': 99}]
+        patch_response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(patch_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        data = [{'id': self.lines1[0].id, 'status': 20},
+                {'id': self.lines1[0].id, 'status': 30}]
+        patch_response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(patch_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        data = [{'id': self.lines1[0].id, 'status': 20},
+                {'id': 0, 'status': 20}]
+        patch_response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(patch_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(patch_response.data['ids'], [0])
+        # Nothing is updated if any line is invalid
+        self.lines1[0].refresh_from_db()
+        self.assertEqual(self.lines1[0].status, models.OrderLine.PROCESSING)
+
+    def test_bulk_update_forbidden_for_not_staff(self):
+        data = [{'id': self.lines1[0].id, 'status': models.OrderLine.SENT}]
+
+        self.client.force_login(self.user)
+        patch_response = self.client.patch(self.url, data, format='json')
+        self.assertEqual(patch_response.status_code,
+                         status.HTTP_403_FORBIDDEN)
+
+
+class TestOrderKeysetPagination(APITestCase):
+
+    def setUp(self):
+        self.user = factories.UserFactory.create(is_staff=True)
+        self.orders = factories.OrderFactory.create_batch(5, user=self.user)
+
+    def test_retrieve_order_list_with_cursor(self):
+        url = '{0}?{1}'.format(
+            reverse('games:{}'.format(OrderList.name)),
+            urlencode({'cursor': '', 'page_size': 2}))
+
+        self.client.force_login(self.user)
+        ids = []
+        while url:
+            get_response = self.client.get(url, format='json')
+            self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+            self.assertNotIn('count', get_response.data)
+            ids.extend(order['id'] for order in get_response.data['results'])
+            url = get_response.data['next']
+
+        expected_ids = list(models.Order.objects.order_by(
+            '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected_ids)
+
+    def test_ordering_parameter_is_ignored_with_cursor(self):
+        url = '{0}?{1}'.format(
+            reverse('games:{}'.format(OrderList.name)),
+            urlencode({'cursor': '', 'page_size': 2,
+                       'ordering': 'date_added'}))
+
+        self.client.force_login(self.user)
+        get_response = self.client.get(url, format='json')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        ids = [order['id'] for order in get_response.data['results']]
+        self.assertEqual(ids, [self.orders[4].id, self.orders[3].id])
+
+    def test_retrieve_order_list_without_cursor(self):
+        url = reverse('games:{}'.format(OrderList.name))
+
+        self.client.force_login(self.user)
+        get_response = self.client.get(url, format='json')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_response.data['count'], 5)
+
+
+class TestOrderQueryCount(APITestCase):
+    """
+    Number of queries must not grow with number of serialized orders.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = factories.UserFactory.create(is_staff=True)
+        cls.products = factories.ProductFactory.create_batch(3)
+
+    def create_orders(self, number):
+        for _ in range(number):
+            address = factories.AddressFactory.create(user=self.user)
+            order = factories.OrderFactory.create(
+                user=self.user, shipping_address=address,
+                billing_address=address)
+            for product in self.products:
+                factories.OrderLineFactory.create(
+                    order=order, product=product)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_order_list_query_count_does_not_grow(self):
+        self.client.force_login(self.user)
+        url = '{0}?{1}'.format(reverse('games:{}'.format(OrderList.name)),
+                               urlencode({'page_size': 50}))
+
+        self.create_orders(2)
+        queries_small_page = self.count_queries(url)
+
+        self.create_orders(20)
+        queries_large_page = self.count_queries(url)
+
+        self.assertEqual(queries_small_page, queries_large_page)
+
+    def test_order_detail_query_count_does_not_grow(self):
+        self.client.force_login(self.user)
+        self.create_orders(1)
+        order = models.Order.objects.get()
+        url = reverse('games:{}'.format(OrderDetail.name),
+                      kwargs={'pk': order.pk})
+
+        queries_few_lines = self.count_queries(url)
+
+        factories.OrderLineFactory.create_batch(
+            10, order=order, product=self.products[0])
+        queries_many_lines = self.count_queries(url)
+
+        self.assertEqual(queries_few_lines, queries_many_lines)
+
+
 class TestIsUserStaff(APITestCase):
 
     def test_is_user_staff(self):
@@ -127,6 +307,18 @@ class TestCart(APITestCase):
         self.assertEqual(len(get_response.data), 1)
         self.assertEqual(cart2['id'], self.cart2.id)
 
+    def test_retrieve_cart_list_with_cursor(self):
+        url = '{0}?{1}'.format(reverse('games:{}'.format(CartList.name)),
+                               urlencode({'cursor': ''}))
+
+        self.client.force_login(self.user1)
+        get_response = self.client.get(url, format='json')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(get_response.data['results']), 1)
+        self.assertEqual(get_response.data['results'][0]['id'],
+                         self.cart1.id)
+        self.assertIsNone(get_response.data['next'])
+
 
 class TestOrdersPerDay(APITestCase):
 
@@ -136,6 +328,12 @@ class TestOrdersPerDay(APITestCase):
         cls.user.is_staff = True
         cls.user.save()
 
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
     def test_valid_period(self):
         p1, p2, p3 = factories.PaymentFactory.create_batch(3)
         p1.date_paid = timezone.now() - timedelta(days=200)
@@ -152,6 +350,9 @@ class TestOrdersPerDay(APITestCase):
         o3 = factories.OrderFactory.create(
             payment=p3, status=models.Order.PAID)
 
+        models.DailyOrderStats.objects.rebuild(
+            timezone.now().date() - timedelta(days=360))
+
         o2_date = o2.payment.date_paid.strftime('%Y-%m-%d')
         o3_date = o3.payment.date_paid.strftime('%Y-%m-%d')
 
@@ -176,6 +377,15 @@ class TestOrdersPerDay(APITestCase):
         self.assertEqual(get_response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(get_response.data), 2)
 
+    def test_orders_per_day_is_forbidden_to_customers(self):
+        self.client.force_login(factories.UserFactory.create())
+
+        get_response = self.client.get(
+            reverse('games:api-orders-per-day', kwargs={'period': 30}),
+            format='json'
+        )
+        self.assertEqual(get_response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_invalid_period(self):
         self.client.force_login(self.user)
 
@@ -189,6 +399,12 @@ class TestOrdersPerDay(APITestCase):
 
 class TestMostBoughtProducts(APITestCase):
 
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
     def test_most_bought_products(self):
         user = factories.UserFactory.create()
         user.is_staff = True
@@ -211,6 +427,9 @@ class TestMostBoughtProducts(APITestCase):
         factories.OrderLineFactory.create_batch(
             1, order=o3, product=p2)
 
+        models.DailyProductStats.objects.rebuild(
+            timezone.now().date() - timedelta(days=360))
+
         self.client.force_login(user)
 
         get_response = self.client.get(
@@ -221,10 +440,183 @@ class TestMostBoughtProducts(APITestCase):
         self.assertEqual(get_response.status_code, status.HTTP_200_OK)
         self.assertCountEqual(
             get_response.data,
-            [{'product_name': p2.name, 'purchase_num': 3},
-             {'product_name': p3.name, 'purchase_num': 2},
-             {'product_name': p1.name, 'purchase_num': 6}]
+            [{'product_name': p2.name, 'purchase_num': 3,
+              'revenue': p2.price * 3},
+             {'product_name': p3.name, 'purchase_num': 2,
+              'revenue': p3.price * 2},
+             {'product_name': p1.name, 'purchase_num': 6,
+              'revenue': p1.price * 6}]
+        )
+
+    def test_most_bought_products_is_forbidden_to_customers(self):
+        self.client.force_login(factories.UserFactory.create())
+
+        get_response = self.client.get(
+            reverse('games:api-most-bought-products',
+                    kwargs={'period': 30}),
+            format='json'
         )
+        self.assertEqual(get_response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_most_bought_products_ranking(self):
+        user = factories.UserFactory.create(is_staff=True)
+        p1, p2 = factories.ProductFactory.create_batch(2)
+        p1.price, p2.price = 10, 50
+        p1.save()
+        p2.save()
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderLineFactory.create(
+            order=order, product=p1, quantity=3)
+        factories.OrderLineFactory.create(
+            order=order, product=p2, quantity=1)
+
+        models.DailyProductStats.objects.rebuild(
+            timezone.now().date() - timedelta(days=360))
+
+        self.client.force_login(user)
+        url = reverse('games:api-most-bought-products',
+                      kwargs={'period': 30})
+
+        get_response = self.client.get(url, format='json')
+        self.assertEqual(
+            [x['product_name'] for x in get_response.data],
+            [p1.name, p2.name])
+
+        get_response = self.client.get(
+            '{}?ranking=revenue'.format(url), format='json')
+        self.assertEqual(
+            [x['product_name'] for x in get_response.data],
+            [p2.name, p1.name])
+
+        get_response = self.client.get(
+            '{}?ranking=invalid'.format(url), format='json')
+        self.assertEqual(get_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class TestOrderStats(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = factories.UserFactory.create(is_staff=True)
+        # Monday 2018-12-31 to Sunday 2019-02-03
+        first_day = date(2018, 12, 31)
+        for n in range(35):
+            models.DailyOrderStats.objects.create(
+                day=first_day + timedelta(days=n), order_num=1, revenue=10)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('games:api-order-stats')
+
+    def tearDown(self):
+        cache.clear()
+
+    def get(self, **params):
+        return self.client.get('{0}?{1}'.format(self.url, urlencode(params)),
+                               format='json')
+
+    def test_order_stats_is_forbidden_to_customers(self):
+        self.client.force_login(factories.UserFactory.create())
+
+        get_response = self.get(from_date='2019-01-01', to_date='2019-01-03')
+        self.assertEqual(get_response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_order_stats_by_day(self):
+        self.client.force_login(self.user)
+
+        get_response = self.get(from_date='2019-01-01', to_date='2019-01-03')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [x['period_start'] for x in get_response.data],
+            ['2019-01-01', '2019-01-02', '2019-01-03'])
+
+    def test_order_stats_by_week(self):
+        self.client.force_login(self.user)
+
+        get_response = self.get(granularity='week', to_date='2019-01-09')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(x['period_start'], x['order_num'], x['revenue'])
+             for x in get_response.data],
+            [('2018-12-31', 7, 70), ('2019-01-07', 3, 30)])
+
+    def test_order_stats_by_month(self):
+        self.client.force_login(self.user)
+
+        get_response = self.get(granularity='month')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(x['period_start'], x['order_num'])
+             for x in get_response.data],
+            [('2018-12-01', 1), ('2019-01-01', 31), ('2019-02-01', 3)])
+
+    def test_order_stats_invalid_parameters(self):
+        self.client.force_login(self.user)
+
+        get_response = self.get(granularity='year')
+        self.assertEqual(get_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        get_response = self.get(from_date='invalid')
+        self.assertEqual(get_response.status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+
+class TestAnalyticsCache(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = factories.UserFactory.create(is_staff=True)
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('games:api-orders-per-day', kwargs={'period': 30})
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_response_is_cached_until_invalidated(self):
+        self.client.force_login(self.user)
+
+        get_response = self.client.get(self.url, format='json')
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_response.data, [])
+
+        models.DailyOrderStats.objects.create(
+            day=timezone.now().date(), order_num=2)
+
+        get_response = self.client.get(self.url, format='json')
+        self.assertEqual(get_response.data, [])
+
+        invalidate_analytics_cache()
+
+        get_response = self.client.get(self.url, format='json')
+        self.assertEqual(get_response.data[0]['order_num'], 2)
+
+    def test_conditional_get_returns_not_modified(self):
+        self.client.force_login(self.user)
+
+        get_response = self.client.get(self.url, format='json')
+        etag = get_response['ETag']
+        last_modified = get_response['Last-Modified']
+
+        get_response = self.client.get(
+            self.url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(get_response.status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        get_response = self.client.get(
+            self.url, format='json', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(get_response.status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        invalidate_analytics_cache()
+
+        get_response = self.client.get(
+            self.url, format='json', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(get_response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(get_response['ETag'], etag)
 
 
 class TestCartManipulation(APITestCase):
@@ -2,8 +2,10 @@ from io import StringIO
 import tempfile
 from django.core.management import call_command
 from django.contrib.auth import get_user_model
-from django.test import TestCase, override_settings
+from django.test import TestCase, TransactionTestCase, override_settings
 from games import models, factories
+from games.benchmarks import Benchmark, Scale, populate
+from games.management.commands.benchmark import Command as BenchmarkCommand
 
 import logging
 logger = logging.getLogger(__name__)
@@ -72,3 +74,82 @@ class TestMockOrders(TestCase):
                 order.id, order.user.email, len(order.lines.all()))
 
         self.assertEqual(self.out.getvalue(), expected_out)
+
+
+class TestBackfillOrderPrices(TestCase):
+
+    def test_backfill_order_prices(self):
+        out = StringIO()
+        product = factories.ProductFactory.create()
+        order = factories.OrderFactory.create()
+        models.OrderLine.objects.create(
+            order=order, product=product, quantity=2)
+
+        call_command('backfill_order_prices', '--batch-size=10', stdout=out)
+
+        self.assertEqual(out.getvalue(),
+                         "Backfilling prices of order lines\n"
+                         "Order lines updated=1\n")
+        line = models.OrderLine.objects.get()
+        self.assertEqual(line.unit_price, product.price)
+        self.assertEqual(line.total_price, product.price * 2)
+
+
+class TestBenchmarkConnections(TransactionTestCase):
+
+    def test_no_products_raise_exception(self):
+        with self.assertRaisesMessage(Exception, 'there must be products'):
+            call_command('benchmark_connections', stdout=StringIO())
+
+    def test_benchmark_connections(self):
+        out = StringIO()
+        product = factories.ProductFactory.create()
+
+        call_command('benchmark_connections', '--requests=2', stdout=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "Benchmarking 2 requests per page")
+        self.assertEqual(len(lines), 5)
+        self.assertIn(product.get_absolute_url(), lines[2])
+        self.assertTrue(lines[3].startswith('persistent connection'))
+
+
+class TestBenchmark(TestCase):
+
+    def test_populate(self):
+        populate(Scale(products=10, order_lines=40))
+
+        self.assertEqual(models.Product.objects.count(), 10)
+        self.assertGreaterEqual(models.OrderLine.objects.count(), 40)
+        self.assertFalse(models.OrderLine.objects.filter(
+            total_price__isnull=True).exists())
+        self.assertTrue(models.DailyOrderStats.objects.exists())
+
+    def test_run(self):
+        factories.ProductFactory.create_batch(5)
+
+        results = Benchmark().run(2, ['home', 'checkout', 'payment'])
+
+        self.assertEqual(list(results), ['home', 'checkout', 'payment'])
+        for result in results.values():
+            self.assertEqual(result['requests'], 2)
+            self.assertEqual(result['errors'], 0)
+            self.assertGreater(result['queries_max'], 0)
+        self.assertFalse(models.Order.objects.exists())
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django_redis.cache.RedisCache',
+                    'LOCATION': 'redis://redis:6379/'},
+        'sessions': {'BACKEND': 'django_redis.cache.RedisCache',
+                     'LOCATION': 'redis://redis:6379/2'},
+        'local': {'BACKEND':
+                  'django.core.cache.backends.locmem.LocMemCache'},
+    })
+    def test_caches_use_separate_redis_database(self):
+        caches = BenchmarkCommand().get_caches(15)
+
+        self.assertEqual(caches['default']['LOCATION'],
+                         'redis://redis:6379/15')
+        self.assertEqual(caches['sessions']['LOCATION'],
+                         'redis://redis:6379/15')
+        self.assertNotIn('LOCATION', caches['local'])
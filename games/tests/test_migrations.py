@@ -0,0 +1,115 @@
+from datetime import date, datetime, time, timezone
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TransactionTestCase
+from .. import models
+
+
+class MigrationTestCase(TransactionTestCase):
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        # leave the latest schema for the following tests
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+
+class TestMarkExistingOrdersConfirmed(MigrationTestCase):
+    migrate_from = [('games', '0006_orderline_price_snapshot')]
+    migrate_to = [('games', '0007_order_confirmation_sent')]
+
+    def test_only_paid_orders_are_marked(self):
+        apps = self.migrate(self.migrate_from)
+        User = apps.get_model('games', 'CustomUser')
+        Order = apps.get_model('games', 'Order')
+        user = User.objects.create(email='old@example.com')
+        new = Order.objects.create(user=user, status=models.Order.NEW)
+        paid = Order.objects.create(user=user, status=models.Order.PAID)
+        done = Order.objects.create(user=user, status=models.Order.DONE)
+
+        apps = self.migrate(self.migrate_to)
+        Order = apps.get_model('games', 'Order')
+
+        self.assertIsNone(Order.objects.get(pk=new.pk).confirmation_sent)
+        self.assertIsNotNone(Order.objects.get(pk=paid.pk).confirmation_sent)
+        self.assertIsNotNone(Order.objects.get(pk=done.pk).confirmation_sent)
+
+
+class TestDedupeSlugs(MigrationTestCase):
+    migrate_from = [('games', '0001_initial')]
+    migrate_to = [('games', '0003_hot_path_indexes')]
+
+    def test_duplicated_slugs_get_id_appended(self):
+        apps = self.migrate(self.migrate_from)
+        Product = apps.get_model('games', 'Product')
+        ProductTag = apps.get_model('games', 'ProductTag')
+        first, second = [
+            Product.objects.create(name='Game', slug='game', price=10)
+            for i in range(2)]
+        taken = Product.objects.create(
+            name='Game', slug='game-{}'.format(second.id), price=10)
+        tags = [ProductTag.objects.create(name='Tag', slug='tag')
+                for i in range(2)]
+
+        apps = self.migrate(self.migrate_to)
+        Product = apps.get_model('games', 'Product')
+        ProductTag = apps.get_model('games', 'ProductTag')
+
+        self.assertEqual(
+            dict(Product.objects.values_list('id', 'slug')),
+            {first.id: 'game',
+             second.id: 'game-{}'.format(second.id + 1),
+             taken.id: 'game-{}'.format(second.id)})
+        self.assertEqual(
+            list(ProductTag.objects.order_by('id').values_list(
+                'slug', flat=True)),
+            ['tag', 'tag-{}'.format(tags[1].id)])
+
+
+class TestRebuildDailyStats(MigrationTestCase):
+    migrate_from = [('games', '0010_order_rollup_stats_added')]
+    migrate_to = [('games', '0011_rebuild_daily_stats')]
+
+    def test_stats_are_rebuilt_over_whole_history(self):
+        apps = self.migrate(self.migrate_from)
+        User = apps.get_model('games', 'CustomUser')
+        Product = apps.get_model('games', 'Product')
+        Payment = apps.get_model('games', 'Payment')
+        Order = apps.get_model('games', 'Order')
+        OrderLine = apps.get_model('games', 'OrderLine')
+        user = User.objects.create(email='old@example.com')
+        product = Product.objects.create(name='Game', slug='game', price=10)
+        payment = Payment.objects.create(user=user, amount=20)
+        paid = Order.objects.create(user=user, status=models.Order.PAID,
+                                    payment=payment)
+        OrderLine.objects.create(order=paid, product=product, quantity=2,
+                                 unit_price=10, total_price=20)
+        new = Order.objects.create(user=user, status=models.Order.NEW)
+        OrderLine.objects.create(order=new, product=product)
+        # paid years ago, beyond the range of reconcile tasks
+        old_day = date(2015, 3, 1)
+        Payment.objects.update(date_paid=old_day)
+        Order.objects.update(date_added=datetime.combine(
+            old_day, time(12), tzinfo=timezone.utc))
+
+        apps = self.migrate(self.migrate_to)
+        Order = apps.get_model('games', 'Order')
+        DailyOrderStats = apps.get_model('games', 'DailyOrderStats')
+        DailyProductStats = apps.get_model('games', 'DailyProductStats')
+
+        self.assertEqual(
+            list(DailyOrderStats.objects.values_list(
+                'day', 'order_num', 'revenue')),
+            [(old_day, 1, 20)])
+        self.assertEqual(
+            list(DailyProductStats.objects.values_list(
+                'day', 'quantity', 'revenue')),
+            [(old_day, 2, 20)])
+        paid = Order.objects.get(pk=paid.pk)
+        self.assertIsNotNone(paid.order_stats_added)
+        self.assertIsNotNone(paid.product_stats_added)
+        self.assertIsNone(Order.objects.get(pk=new.pk).order_stats_added)
@@ -1,6 +1,9 @@
 from decimal import Decimal
-from django.test import TestCase
-from .. import models, factories
+from unittest import skipUnless
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from .. import memoize, models, factories
 
 
 class TestModel(TestCase):
@@ -136,28 +139,101 @@ class TestModel(TestCase):
         self.assertEqual(order.billing_address, billing)
         self.assertEqual(order.status, models.Order.NEW)
 
-    def test_cart_submit_works(self):
+    def test_orderline_update_statuses_works(self):
         p1, p2 = self.products
-
+        order1, order2 = factories.OrderFactory.create_batch(2)
+        line1, line2 = factories.OrderLineFactory.create_batch(
+            2, order=order1, product=p1)
+        line3, line4 = factories.OrderLineFactory.create_batch(
+            2, order=order2, product=p2)
+
+        with self.assertNumQueries(4):
+            updated = models.OrderLine.objects.update_statuses({
+                line1.pk: models.OrderLine.SENT,
+                line2.pk: models.OrderLine.CANCELLED,
+                line3.pk: models.OrderLine.SENT,
+            })
+
+        self.assertEqual(updated, 3)
+        statuses = dict(models.OrderLine.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {
+            line1.pk: models.OrderLine.SENT,
+            line2.pk: models.OrderLine.CANCELLED,
+            line3.pk: models.OrderLine.SENT,
+            line4.pk: models.OrderLine.PROCESSING,
+        })
+        order1.refresh_from_db()
+        order2.refresh_from_db()
+        self.assertEqual(order1.status, models.Order.DONE)
+        self.assertEqual(order2.status, models.Order.NEW)
+
+    def test_cart_pay_works(self):
+        p1, p2 = self.products
+        coupon = models.Coupon.objects.create(code='MINUS5', amount=5)
+        self.cart.coupon = coupon
+        self.cart.save()
         models.CartLine.objects.create(cart=self.cart, product=p1)
-        models.CartLine.objects.create(cart=self.cart, product=p2)
+        models.CartLine.objects.create(
+            cart=self.cart, product=p2, quantity=2)
+        total = self.cart.get_total()
+        new_order = models.Order.objects.create(user=self.user)
 
-        models.Order.objects.create(user=self.user)
+        order = self.cart.pay()
 
-        order = self.cart.submit()
+        self.assertEqual(order, new_order)
         order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.PAID)
+        self.assertEqual(order.payment.amount, total)
+        self.assertCountEqual(
+            order.lines.values_list('product', 'quantity'),
+            [(p1.pk, 1), (p2.pk, 2)])
+        self.assertFalse(models.Cart.objects.filter(pk=self.cart.pk).exists())
+
+    def test_cart_pay_stores_prices(self):
+        p1, p2 = self.products
+        p2.discount_price = p2.price - 1
+        p2.save()
+        models.CartLine.objects.create(cart=self.cart, product=p1)
+        models.CartLine.objects.create(
+            cart=self.cart, product=p2, quantity=2)
+        models.Order.objects.create(user=self.user)
 
-        cart_lines = order.lines.all()
-        order_lines = order.lines.all()
+        order = self.cart.pay()
 
-        self.assertEqual(models.OrderLine.objects.filter(
-            order=order).count(), 2)
         self.assertCountEqual(
-            [cart_lines[0].product, cart_lines[1].product], [p1, p2])
-        self.assertEqual(
-            cart_lines[0].quantity, order_lines[0].quantity)
-        self.assertEqual(
-            cart_lines[1].quantity, order_lines[1].quantity)
+            order.lines.values_list('product', 'unit_price', 'total_price'),
+            [(p1.pk, p1.price, p1.price),
+             (p2.pk, p2.discount_price, p2.discount_price * 2)])
+
+    def test_orderline_backfill_prices(self):
+        p1, p2 = self.products
+        order = factories.OrderFactory.create(user=self.user)
+        models.OrderLine.objects.bulk_create([
+            models.OrderLine(order=order, product=p1),
+            models.OrderLine(order=order, product=p2, quantity=3),
+        ])
+        paid_line = factories.OrderLineFactory.create(
+            order=order, product=p1, unit_price=1, total_price=1)
+
+        # two batches and a check that nothing is left
+        with self.assertNumQueries(5):
+            updated = models.OrderLine.objects.backfill_prices(batch_size=1)
+
+        self.assertEqual(updated, 2)
+        self.assertCountEqual(
+            order.lines.exclude(pk=paid_line.pk)
+            .values_list('unit_price', 'total_price'),
+            [(p1.price, p1.price), (p2.price, p2.price * 3)])
+        paid_line.refresh_from_db()
+        self.assertEqual(paid_line.total_price, 1)
+
+    def test_cart_pay_without_new_order(self):
+        models.CartLine.objects.create(
+            cart=self.cart, product=self.products[0])
+
+        self.assertIsNone(self.cart.pay())
+        self.assertEqual(models.Payment.objects.count(), 0)
+        self.assertTrue(models.Cart.objects.filter(pk=self.cart.pk).exists())
 
     def test_cartline_get_total_product_price_works(self):
         p1, p2 = self.products
@@ -178,3 +254,124 @@ class TestModel(TestCase):
 
         self.assertAlmostEqual(cartline.get_total_product_price(),
                                Decimal(23.98))
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+class TestIndexes(TestCase):
+    """
+    Check that queries on hot paths are able to use index scans.
+    Sequential scans are disabled, so planner takes an index whenever
+    one is applicable regardless of the size of test tables.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = factories.UserFactory.create()
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertUsesIndex(self, queryset, index_names):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan)
+        self.assertTrue(any(name in plan for name in index_names), plan)
+
+    def test_order_user_status_uses_index(self):
+        self.assertUsesIndex(
+            models.Order.objects.filter(
+                user=self.user, status=models.Order.NEW),
+            ['order_user_status_idx'])
+        self.assertUsesIndex(
+            models.Order.objects.filter(
+                user=self.user, status=models.Order.PAID),
+            ['order_user_status_idx'])
+
+    def test_order_status_date_added_uses_index(self):
+        self.assertUsesIndex(
+            models.Order.objects.filter(
+                status=models.Order.PAID,
+                date_added__gte=timezone.now()),
+            ['order_status_date_added_idx'])
+
+    def test_default_address_uses_index(self):
+        self.assertUsesIndex(
+            models.Address.objects.filter(
+                user=self.user,
+                address_type=models.Address.SHIPPING,
+                is_default=True),
+            ['address_user_default_idx'])
+
+    def test_in_stock_products_uses_index(self):
+        self.assertUsesIndex(
+            models.Product.objects.in_stock().order_by('name'),
+            ['product_in_stock_name_idx'])
+
+    def test_slug_lookups_use_unique_index(self):
+        self.assertUsesIndex(
+            models.Product.objects.filter(slug='product'),
+            ['games_product_slug_fb1e3194_uniq'])
+        self.assertUsesIndex(
+            models.ProductTag.objects.filter(slug='tag'),
+            ['games_producttag_slug_3fd3b478_uniq'])
+
+
+class TestRequestMemoized(TestCase):
+
+    def setUp(self):
+        self.cart = factories.CartFactory.create()
+        factories.CartLineFactory.create(cart=self.cart, quantity=2)
+
+    def test_results_are_shared_by_instances_of_request(self):
+        with memoize.request_scope():
+            self.assertEqual(self.cart.count(), 2)
+            cart = models.Cart.objects.get(pk=self.cart.pk)
+            with self.assertNumQueries(0):
+                self.assertEqual(cart.count(), 2)
+                self.assertEqual(self.cart.count(), 2)
+
+    def test_results_are_cleared_on_write(self):
+        with memoize.request_scope():
+            total = self.cart.get_total()
+            factories.CartLineFactory.create(cart=self.cart)
+
+            self.assertEqual(self.cart.count(), 3)
+            self.assertGreater(self.cart.get_total(), total)
+
+    def test_results_are_cleared_on_savepoint_rollback(self):
+        with memoize.request_scope():
+            try:
+                with transaction.atomic():
+                    factories.CartLineFactory.create(cart=self.cart)
+                    self.assertEqual(self.cart.count(), 3)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+
+            self.assertEqual(self.cart.count(), 2)
+
+    def test_results_are_not_kept_outside_of_request(self):
+        with memoize.request_scope():
+            self.cart.count()
+
+        with self.assertNumQueries(2):
+            self.cart.count()
+            self.cart.count()
+
+
+class TestRequestMemoizedRollback(TransactionTestCase):
+
+    def test_results_are_cleared_on_rollback(self):
+        cart = factories.CartFactory.create()
+        factories.CartLineFactory.create(cart=cart, quantity=2)
+
+        with memoize.request_scope():
+            try:
+                with transaction.atomic():
+                    factories.CartLineFactory.create(cart=cart)
+                    self.assertEqual(cart.count(), 3)
+                    raise IntegrityError
+            except IntegrityError:
+                pass
+
+            self.assertEqual(cart.count(), 2)
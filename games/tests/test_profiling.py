@@ -0,0 +1,119 @@
+import os
+import tempfile
+from unittest import skipUnless
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from .. import models, factories, profiling, tasks
+
+
+class ProfilingTestCase(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = os.path.join(directory.name, 'slow_queries.log')
+        settings_override = override_settings(
+            QUERY_PROFILING_ENABLED=True, QUERY_PROFILING_THRESHOLD=0,
+            QUERY_PROFILING_EXPLAIN_SAMPLE_RATE=0,
+            QUERY_PROFILING_ANALYZE_SAMPLE_RATE=0,
+            QUERY_PROFILING_LOG=self.log)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+
+class TestSlowQueryProfiler(ProfilingTestCase):
+
+    def test_slow_queries_are_logged_with_source_and_location(self):
+        with profiling.profile_queries(lambda: 'source'):
+            list(models.Product.objects.all())
+
+        entry, = profiling.read_slow_queries()
+        self.assertEqual(entry['source'], 'source')
+        self.assertIn('games_product', entry['sql'])
+        self.assertTrue(entry['location'].startswith(
+            'games/tests/test_profiling.py:'))
+        self.assertIsNone(entry['plan'])
+
+    @override_settings(QUERY_PROFILING_THRESHOLD=60)
+    def test_fast_queries_are_not_logged(self):
+        with profiling.profile_queries(lambda: 'source'):
+            list(models.Product.objects.all())
+
+        self.assertEqual(profiling.read_slow_queries(), [])
+
+    def test_read_slow_queries_newest_first(self):
+        with open(self.log, 'w') as log_file:
+            log_file.write('{"sql": "first"}\n{"sql": "second"}\n{"sq')
+
+        entries = profiling.read_slow_queries()
+
+        self.assertEqual([entry['sql'] for entry in entries],
+                         ['second', 'first'])
+
+    def test_view_queries_are_logged_with_view_name(self):
+        with self.modify_settings(MIDDLEWARE={
+                'prepend': 'games.middlewares.query_profiling_middleware'}):
+            self.client.get(reverse('games:home'))
+
+        sources = {entry['source'] for entry in profiling.read_slow_queries()}
+        self.assertEqual(sources, {'games:home'})
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_task_queries_are_logged_with_task_name(self):
+        tasks.delete_unactive_carts.delay()
+
+        entries = profiling.read_slow_queries()
+        self.assertTrue(entries)
+        self.assertEqual(entries[0]['source'],
+                         'games.tasks.delete_unactive_carts')
+        self.assertTrue(entries[0]['location'].startswith('games/tasks.py:'))
+
+
+class TestExplain(ProfilingTestCase):
+
+    def test_locking_queries_are_not_explained(self):
+        self.assertIsNone(profiling.LOCKING_CLAUSE.search(
+            'SELECT "games_order"."id" FROM "games_order"'))
+        for clause in ('FOR UPDATE', 'FOR NO KEY UPDATE', 'FOR SHARE',
+                       'FOR KEY SHARE', 'FOR UPDATE NOWAIT'):
+            self.assertTrue(profiling.LOCKING_CLAUSE.search(
+                'SELECT "games_order"."id" FROM "games_order" ' + clause))
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+    @override_settings(QUERY_PROFILING_EXPLAIN_SAMPLE_RATE=1)
+    def test_plan_is_captured_without_running_query(self):
+        factories.ProductFactory.create()
+
+        with profiling.profile_queries(lambda: 'source'):
+            models.Product.objects.filter(in_stock=True).first()
+
+        entry = profiling.read_slow_queries()[0]
+        self.assertIn('Scan', entry['plan'])
+        self.assertNotIn('actual time', entry['plan'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+    @override_settings(QUERY_PROFILING_EXPLAIN_SAMPLE_RATE=1,
+                       QUERY_PROFILING_ANALYZE_SAMPLE_RATE=1)
+    def test_analyzed_plan_is_captured(self):
+        factories.ProductFactory.create()
+
+        with profiling.profile_queries(lambda: 'source'):
+            models.Product.objects.filter(in_stock=True).first()
+
+        entry = profiling.read_slow_queries()[0]
+        self.assertIn('actual time', entry['plan'])
+        self.assertIn('Buffers', entry['plan'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+    @override_settings(QUERY_PROFILING_EXPLAIN_SAMPLE_RATE=1,
+                       QUERY_PROFILING_ANALYZE_SAMPLE_RATE=1)
+    def test_select_for_update_is_not_explained(self):
+        factories.ProductFactory.create()
+
+        with transaction.atomic():
+            with profiling.profile_queries(lambda: 'source'):
+                models.Product.objects.select_for_update().first()
+
+        entry = profiling.read_slow_queries()[0]
+        self.assertIsNone(entry['plan'])
@@ -1,8 +1,9 @@
 import redis
+from unittest.mock import patch
 from django.test import TestCase
 from django.conf import settings
 from .. import factories
-from ..recommender import Recommender
+from ..recommender import Recommender, CircuitBreaker
 
 
 class TestRecommendationSystem(TestCase):
@@ -88,3 +89,62 @@ class TestRecommendationSystem(TestCase):
                               [product2, product1])
         self.assertEqual(self.recommender.suggest_products(product4),
                          [])
+
+
+class TestRecommenderWithoutRedis(TestCase):
+
+    def setUp(self):
+        self.recommender = Recommender()
+        self.product1, self.product2 = factories.ProductFactory.create_batch(2)
+        patcher = patch('games.recommender.breaker', CircuitBreaker(
+            failure_threshold=2, recovery_timeout=30))
+        self.breaker = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(Recommender, 'get_redis')
+        self.get_redis = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.get_redis.return_value.zrange.side_effect = redis.TimeoutError
+        self.get_redis.return_value.pipeline.side_effect = redis.TimeoutError
+
+    def test_redis_errors_are_not_raised(self):
+        self.assertEqual(self.recommender.suggest_products(self.product1), [])
+        self.recommender.products_bought([self.product1, self.product2])
+
+        self.assertEqual(self.breaker.failures, 2)
+
+    def test_open_circuit_skips_redis(self):
+        self.recommender.suggest_products(self.product1)
+        self.recommender.suggest_products(self.product1)
+        self.assertTrue(self.breaker.is_open())
+        self.get_redis.reset_mock()
+
+        self.assertEqual(self.recommender.suggest_products(self.product1), [])
+        self.recommender.products_bought([self.product1, self.product2])
+
+        self.get_redis.assert_not_called()
+
+    def test_circuit_closes_after_recovery(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+        with patch('games.recommender.time.monotonic',
+                   return_value=self.breaker.opened_at + 30):
+            self.assertFalse(self.breaker.is_open())
+        self.get_redis.return_value.zrange.side_effect = None
+        self.get_redis.return_value.zrange.return_value = [
+            str(self.product2.id).encode()]
+
+        self.assertEqual(self.recommender.suggest_products(self.product1),
+                         [self.product2])
+        self.assertEqual(self.breaker.failures, 0)
+
+
+class TestRecommenderRedisConnection(TestCase):
+
+    def test_connection_gives_up_on_slow_redis(self):
+        pool = Recommender().get_redis().connection_pool
+
+        self.assertEqual(pool.connection_kwargs['socket_timeout'],
+                         settings.RECOMMENDER_REDIS_TIMEOUT)
+        self.assertEqual(pool.connection_kwargs['socket_connect_timeout'],
+                         settings.RECOMMENDER_REDIS_TIMEOUT)
@@ -1,8 +1,10 @@
 import os
 import tempfile
+from unittest.mock import patch
+from django.db import connection
 from django.test import TestCase, override_settings
 from django.core.cache import cache
-from .. import models, factories
+from .. import models, factories, signals
 
 
 class TestThumbnailSignal(TestCase):
@@ -123,3 +125,43 @@ class TestOrderlineStatusSignal(TestCase):
         self.assertEqual(
             models.OrderLine.objects.filter(status=20).count(), 2)
         self.assertEqual(order.status, 30)
+
+    def test_orderline_change_order_status_number_of_queries(self):
+        order = factories.OrderFactory.create()
+        product = factories.ProductFactory.create()
+        orderlines = factories.OrderLineFactory.create_batch(
+            10, order=order, product=product)
+
+        for orderline in orderlines:
+            orderline.status = 20
+            # Update of the line and conditional update of the order
+            with self.assertNumQueries(2):
+                orderline.save()
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.DONE)
+
+
+class TestDatabaseConnectionsHealthCheck(TestCase):
+
+    @override_settings(DB_CONN_HEALTH_CHECKS=True)
+    def test_unusable_connection_is_closed(self):
+        connection.ensure_connection()
+        with patch.object(connection, 'is_usable', return_value=False), \
+                patch.object(connection, 'close') as close:
+            signals.check_database_connections()
+        close.assert_called_once_with()
+
+    @override_settings(DB_CONN_HEALTH_CHECKS=True)
+    def test_usable_connection_is_kept(self):
+        connection.ensure_connection()
+        with patch.object(connection, 'close') as close:
+            signals.check_database_connections()
+        close.assert_not_called()
+
+    @override_settings(DB_CONN_HEALTH_CHECKS=False)
+    def test_health_checks_can_be_disabled(self):
+        connection.ensure_connection()
+        with patch.object(connection, 'is_usable') as is_usable:
+            signals.check_database_connections()
+        is_usable.assert_not_called()
@@ -1,26 +1,176 @@
-from datetime import timedelta
+import os
+import csv
+import gzip
+import tempfile
+from datetime import datetime, timedelta
+from smtplib import SMTPException
+from unittest.mock import patch
+from celery.app.task import Context
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.core import mail
 from django.utils import timezone
-from .. import models, factories, tasks
+from prometheus_client import REGISTRY
+from games_ecommerce.celery import app
+from .. import metrics, models, factories, signals, tasks
 
 
 class TestCeleryTask(TestCase):
 
+    def tearDown(self):
+        cache.clear()
+
     @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
     def test_order_created(self):
         user = factories.UserFactory.create()
         order = models.Order.objects.create(user=user)
 
-        task = tasks.order_created.delay(order.pk)
+        tasks.order_created.delay(order.pk)
+
+        # confirmation is left to the batch task
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_send_order_confirmations(self):
+        orders = factories.OrderFactory.create_batch(
+            3, status=models.Order.PAID)
+        product = factories.ProductFactory.create()
+        for order in orders:
+            factories.OrderLineFactory.create(order=order, product=product)
+        factories.OrderFactory.create()
+
+        with self.assertNumQueries(3):
+            task = tasks.send_order_confirmations.delay()
+
+        self.assertEqual(task.get(), 3)
+        self.assertCountEqual(
+            [message.subject for message in mail.outbox],
+            ['Order nr. {}'.format(order.pk) for order in orders])
+        self.assertIn(product.name, mail.outbox[0].body)
+        self.assertFalse(models.Order.objects.pending_confirmation().exists())
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_send_order_confirmations_is_idempotent(self):
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        claimed = factories.OrderFactory.create(status=models.Order.PAID)
+        # claimed by another worker
+        cache.add(tasks.CONFIRMATION_KEY.format(claimed.pk), True)
+
+        self.assertEqual(tasks.send_order_confirmations.delay().get(), 1)
+        self.assertEqual(tasks.send_order_confirmations.delay().get(), 0)
 
-        self.assertEqual(task.get(), 1)
         self.assertEqual(len(mail.outbox), 1)
         self.assertEqual(mail.outbox[0].subject,
                          'Order nr. {}'.format(order.pk))
-        # self.assertEqual(mail.outbox[0].message,
-        #                  'You have successfully placed an order.\n'
-        #                  + 'Your order ID is {}'.format(order.pk))
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_send_order_confirmations_releases_unsent_orders(self):
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+
+        with patch('django.core.mail.backends.locmem.EmailBackend'
+                   '.send_messages', side_effect=SMTPException):
+            with self.assertRaises(SMTPException):
+                tasks.send_order_confirmations.delay().get()
+
+        self.assertTrue(models.Order.objects.pending_confirmation().exists())
+        self.assertIsNone(
+            cache.get(tasks.CONFIRMATION_KEY.format(order.pk)))
+
+        self.assertEqual(tasks.send_order_confirmations.delay().get(), 1)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_order_created_updates_daily_order_stats(self):
+        order1, order2 = factories.OrderFactory.create_batch(
+            2, status=models.Order.PAID)
+
+        tasks.order_created.delay(order1.pk)
+        tasks.order_created.delay(order2.pk)
+
+        stats = models.DailyOrderStats.objects.get()
+        self.assertEqual(stats.day, order1.payment.date_paid)
+        self.assertEqual(stats.order_num, 2)
+        self.assertEqual(stats.revenue,
+                         order1.payment.amount + order2.payment.amount)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_order_created_adds_order_to_stats_once(self):
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderLineFactory.create(
+            order=order, product=factories.ProductFactory.create(),
+            quantity=2)
+
+        # e.g. redelivered to another worker
+        tasks.order_created.delay(order.pk)
+        tasks.order_created.delay(order.pk)
+
+        self.assertEqual(models.DailyOrderStats.objects.get().order_num, 1)
+        self.assertEqual(models.DailyProductStats.objects.get().quantity, 2)
+        order.refresh_from_db()
+        self.assertIsNotNone(order.order_stats_added)
+        self.assertIsNotNone(order.product_stats_added)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_order_created_after_reconcile_adds_only_missing_stats(self):
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderLineFactory.create(
+            order=order, product=factories.ProductFactory.create())
+
+        tasks.reconcile_daily_order_stats.delay()
+        tasks.order_created.delay(order.pk)
+
+        self.assertEqual(models.DailyOrderStats.objects.get().order_num, 1)
+        # product statistics are not rebuilt yet, the task adds the order
+        self.assertEqual(models.DailyProductStats.objects.get().quantity, 1)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_reconcile_daily_order_stats(self):
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderFactory.create(status=models.Order.NEW)
+        models.DailyOrderStats.objects.create(
+            day=order.payment.date_paid, order_num=5)
+        old_stats = models.DailyOrderStats.objects.create(
+            day=timezone.now().date() - timedelta(days=400), order_num=3)
+
+        task = tasks.reconcile_daily_order_stats.delay()
+
+        self.assertEqual(task.get(), 1)
+        stats = models.DailyOrderStats.objects.get(
+            day=order.payment.date_paid)
+        self.assertEqual(stats.order_num, 1)
+        self.assertEqual(stats.revenue, order.payment.amount)
+        # Days out of reconciled range stay untouched
+        old_stats.refresh_from_db()
+        self.assertEqual(old_stats.order_num, 3)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_reconcile_daily_product_stats(self):
+        product = factories.ProductFactory.create()
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderLineFactory.create_batch(
+            2, order=order, product=product, quantity=2)
+
+        task = tasks.reconcile_daily_product_stats.delay()
+
+        self.assertEqual(task.get(), 1)
+        stats = models.DailyProductStats.objects.get()
+        self.assertEqual(stats.product, product)
+        self.assertEqual(stats.line_num, 2)
+        self.assertEqual(stats.quantity, 4)
+        self.assertEqual(stats.revenue, product.price * 4)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_reconcile_daily_product_stats_uses_paid_prices(self):
+        product = factories.ProductFactory.create(price=10)
+        order = factories.OrderFactory.create(status=models.Order.PAID)
+        factories.OrderLineFactory.create(
+            order=order, product=product, quantity=2)
+        product.price = 20
+        product.save()
+
+        tasks.reconcile_daily_product_stats.delay()
+
+        stats = models.DailyProductStats.objects.get()
+        self.assertEqual(stats.revenue, 20)
 
     @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
     def test_contact_us_form_filled(self):
@@ -54,3 +204,115 @@ class TestCeleryTask(TestCase):
         self.assertEqual(models.Cart.objects.count(), 1)
         self.assertEqual(models.Cart.objects.filter(
             user=user2).count(), 0)
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True,
+                       EXPORT_ROOT=tempfile.gettempdir(), SITE_SCHEME='https')
+    def test_export_to_csv_file(self):
+        user = factories.UserFactory.create(is_staff=True)
+        orders = factories.OrderFactory.create_batch(3)
+        factories.OrderFactory.create()
+        pks = [order.pk for order in orders]
+
+        task = tasks.export_to_csv_file.delay('games.Order', user.pk, pks=pks)
+        url = task.get()
+
+        filename = url.rsplit('/', 1)[-1]
+        path = os.path.join(tempfile.gettempdir(), filename)
+        with gzip.open(path, 'rt', newline='') as f:
+            rows = list(csv.reader(f))
+        os.remove(path)
+
+        self.assertEqual(len(rows), 4)
+        self.assertCountEqual([int(row[0]) for row in rows[1:]], pks)
+        self.assertTrue(url.startswith('https://'))
+        self.assertIn('/admin/exports/order-', url)
+        # random part makes file name unguessable
+        self.assertGreater(len(filename), len('order-20201001120000.csv.gz'))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [user.email])
+        self.assertIn(url, mail.outbox[0].body)
+
+
+class TestTaskRouting(TestCase):
+
+    def get_queue(self, task):
+        return app.amqp.router.route({}, task.name)['queue'].name
+
+    def test_tasks_are_routed_to_queues(self):
+        expected = {
+            tasks.order_created: 'transactional',
+            tasks.send_order_confirmations: 'transactional',
+            tasks.contact_us_form_filled: 'bulk',
+            tasks.export_to_csv_file: 'bulk',
+            tasks.delete_unactive_carts: 'maintenance',
+            tasks.reconcile_daily_order_stats: 'maintenance',
+            tasks.reconcile_daily_product_stats: 'maintenance',
+        }
+        for task, queue in expected.items():
+            with self.subTest(task=task.name):
+                self.assertEqual(self.get_queue(task), queue)
+
+    def test_heavy_tasks_are_acknowledged_late(self):
+        self.assertTrue(tasks.export_to_csv_file.acks_late)
+        self.assertTrue(tasks.reconcile_daily_product_stats.acks_late)
+        self.assertFalse(tasks.order_created.acks_late)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, METRICS_ENABLED=True)
+class TestTaskMetrics(TestCase):
+
+    def get_sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_runtime_and_queries_are_observed(self):
+        task = 'games.tasks.delete_unactive_carts'
+        runs = self.get_sample('games_task_runtime_seconds_count', task=task)
+        queries = self.get_sample('games_task_queries_sum', task=task)
+
+        tasks.delete_unactive_carts.delay()
+
+        self.assertEqual(self.get_sample(
+            'games_task_runtime_seconds_count', task=task), runs + 1)
+        self.assertGreater(
+            self.get_sample('games_task_queries_sum', task=task), queries)
+
+    def test_failures_are_counted(self):
+        labels = {'task': 'games.tasks.order_created',
+                  'exception': 'DoesNotExist'}
+        failures = self.get_sample('games_task_failures_total', **labels)
+
+        tasks.order_created.delay(0)
+
+        self.assertEqual(
+            self.get_sample('games_task_failures_total', **labels),
+            failures + 1)
+
+    def test_publish_time_is_sent_in_headers(self):
+        headers = {}
+
+        with patch('time.time', return_value=100.0):
+            signals.stamp_task_published_at(headers=headers)
+
+        self.assertEqual(headers, {metrics.PUBLISHED_AT_HEADER: 100.0})
+
+    def test_queue_wait(self):
+        request = Context({metrics.PUBLISHED_AT_HEADER: 100.0})
+        self.assertEqual(metrics.get_queue_wait(request, now=102.5), 2.5)
+
+        # scheduled task waits since its ETA
+        eta = datetime.fromtimestamp(101.0, tz=timezone.utc).isoformat()
+        request = Context({metrics.PUBLISHED_AT_HEADER: 100.0, 'eta': eta})
+        self.assertEqual(metrics.get_queue_wait(request, now=102.5), 1.5)
+
+        # eager task
+        self.assertIsNone(metrics.get_queue_wait(Context(), now=102.5))
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_exited_pool_process_is_marked_dead(self):
+        with patch.dict(os.environ, {'prometheus_multiproc_dir': '/tmp'}), \
+                patch('prometheus_client.multiprocess.mark_process_dead') \
+                as mark_process_dead:
+            signals.worker_process_shutdown.send(
+                sender=None, pid=123, exitcode=0)
+
+        mark_process_dead.assert_called_once_with(123)
@@ -1,13 +1,28 @@
 import logging
+import threading
+import redis
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
-from django.test import TestCase
+from unittest import skipUnless
+from unittest.mock import patch
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, resolve
 from django.contrib import auth
-from .. import views, models, forms, factories
+from .. import views, metrics, models, forms, factories
+from ..recommender import Recommender, CircuitBreaker
+from prometheus_client import REGISTRY
 
 
 logger = logging.getLogger(__name__)
 
+# Session, user, cart, locks, payment, lines, order, cart deletion
+PAYMENT_QUERY_BUDGET = 18
+# Cart of middleware, user, navbar count, cart with coupon and lines
+ORDER_SUMMARY_QUERY_BUDGET = 5
+
 
 class TestHomePage(TestCase):
 
@@ -58,6 +73,188 @@ class TestHomePage(TestCase):
         )
 
 
+class TestSessionQueries(TestCase):
+
+    def get_session_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [query['sql'] for query in context.captured_queries
+                if 'django_session' in query['sql']]
+
+    def test_anonymous_browsing_makes_no_session_queries(self):
+        self.assertEqual(self.get_session_queries(reverse('games:home')), [])
+
+    def test_anonymous_cart_makes_no_session_queries(self):
+        product = factories.ProductFactory.create()
+        self.client.get(product.get_add_to_cart_url())
+
+        self.assertEqual(self.get_session_queries(reverse('games:home')), [])
+        self.assertEqual(
+            self.get_session_queries(reverse('games:order-summary')), [])
+
+
+class TestOrderSummaryQueries(TestCase):
+
+    def setUp(self):
+        self.user = factories.UserFactory.create()
+        coupon = models.Coupon.objects.create(code='SALE', amount=5)
+        self.cart = factories.CartFactory.create(user=self.user, coupon=coupon)
+        self.client.force_login(self.user)
+        session = self.client.session
+        session['cart_id'] = self.cart.pk
+        session.save()
+
+    def get_order_summary_queries(self, number_of_lines):
+        factories.CartLineFactory.create_batch(number_of_lines,
+                                               cart=self.cart)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('games:order-summary'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Total price')
+        return len(context.captured_queries)
+
+    def test_number_of_queries_is_constant(self):
+        queries = self.get_order_summary_queries(1)
+        self.assertLessEqual(queries, ORDER_SUMMARY_QUERY_BUDGET)
+
+        self.assertEqual(self.get_order_summary_queries(5), queries)
+
+
+class TestProductDetailView(TestCase):
+
+    def setUp(self):
+        self.product1, self.product2, self.product3 = (
+            factories.ProductFactory.create_batch(3))
+        patcher = patch('games.recommender.breaker', CircuitBreaker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(Recommender, 'get_redis')
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def get(self, product):
+        return self.client.get(reverse('games:product',
+                                       kwargs={'slug': product.slug}))
+
+    def test_product_page_shows_suggestions(self):
+        self.redis.zrange.return_value = [str(self.product2.id).encode()]
+
+        response = self.get(self.product1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['product'], self.product1)
+        self.assertEqual(response.context['suggested_products'],
+                         [self.product2])
+        self.redis.zrange.assert_called_once_with(
+            'product:{}:purchased_with'.format(self.product1.id),
+            0, 2, desc=True)
+
+    def test_product_page_works_without_redis(self):
+        self.redis.zrange.side_effect = redis.TimeoutError
+
+        response = self.get(self.product1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['suggested_products']), 3)
+
+
+@override_settings(
+    METRICS_ENABLED=True, METRICS_SLOW_REQUEST_SAMPLE_RATE=0,
+    MIDDLEWARE=['games.middlewares.metrics_middleware'] + settings.MIDDLEWARE)
+class TestMetrics(TestCase):
+
+    def get_sample(self, name, view):
+        return REGISTRY.get_sample_value(name, {'view': view}) or 0
+
+    def test_queries_are_observed_per_view(self):
+        factories.ProductFactory.create()
+        requests = self.get_sample('games_request_queries_count', 'games:home')
+        queries = self.get_sample('games_request_queries_sum', 'games:home')
+
+        with CaptureQueriesContext(connection) as context:
+            self.client.get(reverse('games:home'))
+
+        self.assertEqual(self.get_sample(
+            'games_request_queries_count', 'games:home'), requests + 1)
+        self.assertEqual(
+            self.get_sample('games_request_queries_sum', 'games:home'),
+            queries + len(context.captured_queries))
+
+    @override_settings(METRICS_SLOW_REQUEST_SAMPLE_RATE=1,
+                       METRICS_SLOW_REQUEST_THRESHOLD=0)
+    def test_slow_request_is_logged_with_queries(self):
+        factories.ProductFactory.create()
+
+        with self.assertLogs('games.metrics', 'WARNING') as logs:
+            self.client.get(reverse('games:home'))
+
+        self.assertIn('Slow request GET / (games:home)', logs.output[0])
+        self.assertIn('games_product', logs.output[0])
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('games:about-us'))
+
+        response = self.client.get(reverse('games:metrics'),
+                                   HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'games_request_latency_seconds_count'
+                                      '{view="games:about-us"}')
+
+    def test_redis_calls_are_counted(self):
+        client = metrics.InstrumentedRedis()
+
+        with patch.object(redis.Redis, 'execute_command'), \
+                patch.object(redis.client.Pipeline, 'execute'), \
+                metrics.record_request() as recorder:
+            client.get('key')
+            pipe = client.pipeline()
+            pipe.get('key1')
+            pipe.get('key2')
+            pipe.execute()
+
+        # pipeline is a single round trip
+        self.assertEqual(recorder.redis_calls, 2)
+
+    def test_redis_calls_of_bound_threads_are_counted(self):
+        client = metrics.InstrumentedRedis()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        with patch.object(redis.Redis, 'execute_command'), \
+                metrics.record_request() as recorder:
+            executor.submit(client.get, 'key').result()
+            executor.submit(
+                metrics.bind_recorder(client.get), 'key').result()
+
+        self.assertEqual(recorder.redis_calls, 1)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_endpoint_requires_token(self):
+        response = self.client.get(reverse('games:metrics'))
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(reverse('games:metrics'),
+                                   HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_metrics_endpoint_without_token_is_hidden(self):
+        response = self.client.get(reverse('games:metrics'))
+        self.assertEqual(response.status_code, 404)
+
+        with self.settings(DEBUG=True):
+            response = self.client.get(reverse('games:metrics'))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_metrics_endpoint_is_disabled(self):
+        response = self.client.get(reverse('games:metrics'))
+        self.assertEqual(response.status_code, 404)
+
+
 class TestAboutUsPage(TestCase):
 
     def test_about_us_page_works(self):
@@ -437,6 +634,130 @@ class TestPaymentView(TestCase):
         self.assertRedirects(response, reverse("games:home"))
 
 
+class TestPaymentPost(TestCase):
+
+    def setUp(self):
+        self.user = factories.UserFactory.create()
+        self.products = factories.ProductFactory.create_batch(5)
+        self.client.force_login(self.user)
+
+    def pay(self, products):
+        for product in products:
+            self.client.get(product.get_add_to_cart_url())
+        models.Order.objects.create(user=self.user)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(reverse('games:payment'))
+        # count before assertRedirects, its request resets query log
+        number_of_queries = len(context.captured_queries)
+        self.assertRedirects(response, reverse('games:home'))
+        return number_of_queries
+
+    def test_payment_works(self):
+        self.pay(self.products[:2])
+
+        order = models.Order.objects.get(user=self.user)
+        self.assertEqual(order.status, models.Order.PAID)
+        self.assertEqual(order.lines.count(), 2)
+        self.assertFalse(models.Cart.objects.filter(user=self.user).exists())
+        self.assertNotIn('cart_id', self.client.session)
+
+    def test_payment_query_budget(self):
+        queries_one_line = self.pay(self.products[:1])
+        queries_five_lines = self.pay(self.products)
+
+        self.assertEqual(queries_one_line, queries_five_lines)
+        self.assertLessEqual(queries_five_lines, PAYMENT_QUERY_BUDGET)
+
+    def test_payment_without_new_order_redirects(self):
+        self.client.get(self.products[0].get_add_to_cart_url())
+
+        response = self.client.post(reverse('games:payment'))
+        self.assertRedirects(response, reverse('games:checkout'))
+        self.assertEqual(models.Payment.objects.count(), 0)
+
+    def test_payment_of_already_paid_cart_redirects(self):
+        self.client.get(self.products[0].get_add_to_cart_url())
+        models.Order.objects.create(user=self.user)
+
+        def pay_concurrently(cart):
+            cart.delete()
+            return None
+
+        with patch.object(models.Cart, 'pay', autospec=True,
+                          side_effect=pay_concurrently):
+            response = self.client.post(reverse('games:payment'),
+                                        follow=True)
+
+        self.assertRedirects(response, reverse('games:home'))
+        self.assertIn('Your order has already been paid.',
+                      [str(message) for message in response.context[
+                          'messages']])
+        self.assertNotIn('cart_id', self.client.session)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Requires PostgreSQL')
+class TestConcurrentPayments(TransactionTestCase):
+    """
+    Load test of concurrent checkouts: every thread uses its own
+    database connection.
+    """
+    number_of_users = 8
+
+    def pay_in_threads(self, carts):
+        barrier = threading.Barrier(len(carts))
+        results = []
+
+        def pay(cart):
+            try:
+                barrier.wait()
+                results.append(cart.pay())
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=pay, args=(cart,))
+                   for cart in carts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def create_cart(self, user, products):
+        cart = models.Cart.objects.create(user=user)
+        for product in products:
+            models.CartLine.objects.create(cart=cart, product=product)
+        models.Order.objects.create(user=user)
+        return cart
+
+    def test_concurrent_checkouts_of_different_users(self):
+        products = factories.ProductFactory.create_batch(3)
+        users = factories.UserFactory.create_batch(self.number_of_users)
+        carts = [self.create_cart(user, products) for user in users]
+
+        results = self.pay_in_threads(carts)
+
+        self.assertTrue(all(results))
+        self.assertEqual(models.Payment.objects.count(), len(users))
+        self.assertEqual(models.Order.objects.filter(
+            status=models.Order.PAID).count(), len(users))
+        self.assertEqual(models.OrderLine.objects.count(),
+                         len(users) * len(products))
+        self.assertEqual(models.Cart.objects.count(), 0)
+
+    def test_concurrent_checkouts_of_same_cart(self):
+        products = factories.ProductFactory.create_batch(3)
+        user = factories.UserFactory.create()
+        cart = self.create_cart(user, products)
+
+        results = self.pay_in_threads(
+            [models.Cart.objects.get(pk=cart.pk) for _ in range(4)])
+
+        self.assertEqual(len([order for order in results if order]), 1)
+        self.assertEqual(models.Payment.objects.count(), 1)
+        self.assertEqual(models.OrderLine.objects.count(), len(products))
+
+
 class TestSearchView(TestCase):
 
     def setUp(self):
@@ -39,6 +39,9 @@ urlpatterns = [
     path('remove_from_cart/<slug>', views.remove_from_cart,
          name='remove-from-cart'),
 
+    # Prometheus
+    path('metrics', views.metrics_view, name='metrics'),
+
     # API
     path('api/', include('games.api.urls')),
 ]
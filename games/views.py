@@ -1,6 +1,7 @@
 import logging
 import random
 from functools import wraps
+from django.conf import settings
 from django.contrib import messages
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse_lazy
@@ -10,9 +11,12 @@ from django.contrib.auth.views import redirect_to_login
 from django.contrib.postgres.search import (SearchVector, SearchQuery,
                                             SearchRank, TrigramSimilarity)
 from django.core.cache import cache
+from django.http import Http404, HttpResponse
 from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.db.models.functions import Greatest
-from . import forms, models
+from django.utils.crypto import constant_time_compare
+from . import forms, metrics, models
 from .mixins import LoggedOpenCartExistsMixin, IsStaffMixin, CartContextMixin
 from .recommender import Recommender
 from .tasks import order_created
@@ -77,13 +81,15 @@ class ProductDetailView(View):
     def get(self, request, slug, *args, **kwargs):
         context = {}
 
-        products = models.Product.objects.prefetch_related(
-            'images', 'tags').order_by('name')
-        product = products.get(slug=slug)
+        product = models.Product.objects.get(slug=slug)
         context['product'] = product
 
         num_of_suggested = 3
-        suggested_products = r.suggest_products(product, num_of_suggested)
+        suggested_ids = r.suggest_product_ids_in_background(
+            product.id, num_of_suggested)
+        # Load images and tags while suggestions are read from Redis
+        prefetch_related_objects([product], 'images', 'tags')
+        suggested_products = r.get_products(suggested_ids.result())
 
         if not suggested_products:
             products = models.Product.objects.prefetch_related('images')
@@ -143,11 +149,14 @@ class CheckoutView(LoggedOpenCartExistsMixin, CartContextMixin, View):
                          {'name': 'billing_address',
                           'type': models.Address.BILLING}]
 
+        default_addresses = {
+            address.address_type: address for address in
+            models.Address.objects.filter(user=request.user, is_default=True)
+        }
         for address in address_types:
-            default_address, exists = self.get_default_address_if_exists(
-                address['type'])
-            if exists:
-                context.update({address['name']: default_address})
+            if address['type'] in default_addresses:
+                context.update(
+                    {address['name']: default_addresses[address['type']]})
 
         return render(request, 'checkout.html', context)
 
@@ -178,13 +187,13 @@ class CheckoutView(LoggedOpenCartExistsMixin, CartContextMixin, View):
         """
         Check if user has default address of requested type.
         """
-        default_address_qs = models.Address.objects.filter(
+        default_address = models.Address.objects.filter(
             user=self.request.user,
             address_type=address_type,
             is_default=True,
-        )
-        if default_address_qs.exists():
-            return default_address_qs[0], True
+        ).first()
+        if default_address:
+            return default_address, True
         return '', False
 
     def get_address_from_form(self, form, address_type):
@@ -279,31 +288,35 @@ class PaymentView(CartContextMixin, View):
     """
 
     def get(self, request, *args, **kwargs):
+        if not models.Order.objects.filter(
+                user=request.user, status=models.Order.NEW).exists():
+            return self.handle_no_order()
+
         context = self.get_context_data()
         return render(request, 'payment.html', context)
 
-    @transaction.atomic
     def post(self, request, *args, **kwargs):
-        cart = request.cart
-        # Create the payment
-        payment = models.Payment(
-            user=request.user, amount=cart.get_total())
-        payment.save()
-
-        order = cart.submit()
-        # Assign the payment to the order
-        order.payment = payment
-        order.status = models.Order.PAID
-        order.save()
-        # Delete cart
+        # Create the payment, assign it to the order and delete cart
+        order = request.cart.pay()
+        if order is None:
+            if models.Cart.objects.filter(pk=request.cart.pk).exists():
+                return self.handle_no_order()
+            # Cart was paid by a concurrent request, e.g. the form
+            # was submitted twice
+            del self.request.session['cart_id']
+            messages.info(request, 'Your order has already been paid.')
+            return redirect('games:home')
         del self.request.session['cart_id']
-        cart.delete()
 
         # Send e-mail to the customer
         transaction.on_commit(lambda: order_created.delay(order.id))
         messages.success(request, 'Your order was successfully paid!')
         return redirect('games:home')
 
+    def handle_no_order(self):
+        messages.warning(self.request, 'Please assign address to your order.')
+        return redirect('games:checkout')
+
     def dispatch(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
             return redirect_to_login(request.get_full_path())
@@ -312,11 +325,6 @@ class PaymentView(CartContextMixin, View):
             messages.warning(self.request, 'Your cart is empty')
             return redirect('games:home')
 
-        if not models.Order.objects.filter(
-                user=request.user, status=models.Order.NEW).exists():
-            messages.warning(request, 'Please assign address to your order.')
-            return redirect('games:checkout')
-
         return super().dispatch(request, *args, **kwargs)
 
 
@@ -406,3 +414,22 @@ def remove_from_cart(request, slug, cartline):
     """
     cartline.delete()
     return redirect('games:order-summary')
+
+
+def metrics_view(request):
+    """
+    Expose request metrics to Prometheus. METRICS_TOKEN must be sent
+    as bearer token, without it metrics are exposed only with DEBUG on.
+    """
+    if not settings.METRICS_ENABLED:
+        raise Http404
+    if not settings.METRICS_TOKEN:
+        if not settings.DEBUG:
+            raise Http404
+    elif not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''),
+            'Bearer {}'.format(settings.METRICS_TOKEN)):
+        return HttpResponse(status=403)
+
+    content, content_type = metrics.generate_metrics()
+    return HttpResponse(content, content_type=content_type)
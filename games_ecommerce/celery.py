@@ -19,4 +19,19 @@ app.conf.beat_schedule = {
         'schedule': crontab(hour=4, day_of_week='2, 5'),
         'args': (),
     },
+    'send_order_confirmations': {
+        'task': 'games.tasks.send_order_confirmations',
+        'schedule': crontab(minute='*'),
+        'args': (),
+    },
+    'reconcile_daily_order_stats': {
+        'task': 'games.tasks.reconcile_daily_order_stats',
+        'schedule': crontab(hour=3, minute=0),
+        'args': (),
+    },
+    'reconcile_daily_product_stats': {
+        'task': 'games.tasks.reconcile_daily_product_stats',
+        'schedule': crontab(hour=3, minute=30),
+        'args': (),
+    },
 }
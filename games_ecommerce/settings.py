@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 import os
 from dotenv import load_dotenv
+from kombu import Queue
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -64,6 +65,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -71,6 +73,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'games.middlewares.memoize_middleware',
     'games.middlewares.cart_middleware',
     # 'debug_toolbar.middleware.DebugToolbarMiddleware',
 ]
@@ -100,6 +103,13 @@ WSGI_APPLICATION = 'games_ecommerce.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
+# Connection reuse: 'none' opens a connection for every request or task,
+# 'persistent' keeps it open for DB_CONN_MAX_AGE seconds and 'pgbouncer'
+# keeps it open to pgbouncer running in transaction pooling mode
+DB_POOL_MODE = os.environ.get('DB_POOL_MODE', 'persistent')
+# Test persistent connections before they are reused
+DB_CONN_HEALTH_CHECKS = int(os.environ.get('DB_CONN_HEALTH_CHECKS', 1))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -107,10 +117,31 @@ DATABASES = {
         'USER': os.environ.get('POSTGRES_USER', 'postgres'),
         'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
         'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
-        'PORT': 5432
+        'PORT': int(os.environ.get('POSTGRES_PORT', 5432)),
+        'CONN_MAX_AGE': (0 if DB_POOL_MODE == 'none' else
+                         int(os.environ.get('DB_CONN_MAX_AGE', 60))),
     }
 }
 
+# Alias of the database CSV exports read rows from, streamed through a
+# server-side cursor
+EXPORT_DATABASE = 'default'
+
+if DB_POOL_MODE == 'pgbouncer':
+    # Server connection may change between transactions, so cursors
+    # can't outlive them
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+    # Exports connect to Postgres directly to keep streaming
+    DATABASES['direct'] = dict(
+        DATABASES['default'],
+        HOST=os.environ.get('POSTGRES_DIRECT_HOST', 'db'),
+        PORT=int(os.environ.get('POSTGRES_DIRECT_PORT', 5432)),
+        CONN_MAX_AGE=0,
+        DISABLE_SERVER_SIDE_CURSORS=False,
+        TEST={'MIRROR': 'default'},
+    )
+    EXPORT_DATABASE = 'direct'
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -145,6 +176,14 @@ USE_TZ = True
 
 SESSION_COOKIE_AGE = 7 * 24 * 60 * 60
 
+# Sessions are read on every page for cart, 'cached_db' serves reads
+# from Redis, 'cache' doesn't touch database at all and 'db' always does
+SESSION_ENGINE = 'django.contrib.sessions.backends.{}'.format(
+    os.environ.get('SESSION_BACKEND', 'cached_db'))
+SESSION_CACHE_ALIAS = 'sessions'
+# Session is saved only when it was modified
+SESSION_SAVE_EVERY_REQUEST = False
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
@@ -155,15 +194,29 @@ STATICFILES_DIRS = [
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles/')
 
+if not DEBUG:
+    # Compressed files with hashed names, served by WhiteNoise with
+    # far-future cache headers; requires 'collectstatic'
+    STATICFILES_STORAGE = (
+        'whitenoise.storage.CompressedManifestStaticFilesStorage')
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
 
+# CSV exports contain personal data, they are kept outside of MEDIA_ROOT
+# and served to staff by admin
+EXPORT_ROOT = os.environ.get('EXPORT_ROOT', os.path.join(BASE_DIR, 'exports'))
+
+# Scheme of absolute links built outside of requests, e.g. in e-mails
+SITE_SCHEME = os.environ.get('SITE_SCHEME', 'https')
+
 STATICFILES_FINDERS = [
     "django.contrib.staticfiles.finders.FileSystemFinder",
     "django.contrib.staticfiles.finders.AppDirectoriesFinder",
 ]
 
-MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
+# Messages are kept in cookie and don't cause session writes
+MESSAGE_STORAGE = 'django.contrib.messages.storage.fallback.FallbackStorage'
 
 # REDIS
 
@@ -171,6 +224,19 @@ REDIS_HOST = os.environ.get('REDIS_HOST', 'localhost')
 REDIS_PORT = 6379
 REDIS_DB = 1
 
+# Cache whose Redis connection pool is used by recommender, set to
+# 'default' to share pool and database with the cache; its socket
+# timeouts are set to RECOMMENDER_REDIS_TIMEOUT below
+RECOMMENDER_CACHE_ALIAS = os.environ.get(
+    'RECOMMENDER_CACHE_ALIAS', 'recommender')
+# Seconds to wait for Redis before page is shown without suggestions
+RECOMMENDER_REDIS_TIMEOUT = float(
+    os.environ.get('RECOMMENDER_REDIS_TIMEOUT', 0.2))
+RECOMMENDER_FAILURE_THRESHOLD = 3
+RECOMMENDER_RECOVERY_TIMEOUT = 30
+# Threads fetching suggestions while product page queries database
+RECOMMENDER_THREADS = int(os.environ.get('RECOMMENDER_THREADS', 4))
+
 
 # EMAIL
 
@@ -187,9 +253,91 @@ CACHES = {
         'OPTIONS': {
             'CLIENT_CLASS': 'django_redis.client.DefaultClient',
         }
-    }
+    },
+    'recommender': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://{0}:{1}/{2}'.format(
+            REDIS_HOST, REDIS_PORT, REDIS_DB),
+
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
+    },
+    # Separate database, so clearing the cache doesn't log users out
+    'sessions': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': 'redis://{0}:{1}/2'.format(REDIS_HOST, REDIS_PORT),
+
+        'OPTIONS': {
+            'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+        }
+    },
 }
 
+# Recommender gives up quickly on slow Redis whichever cache it uses, so
+# its circuit breaker can trip; with 'default' this applies to the cache
+CACHES[RECOMMENDER_CACHE_ALIAS]['OPTIONS'].update({
+    'SOCKET_CONNECT_TIMEOUT': RECOMMENDER_REDIS_TIMEOUT,
+    'SOCKET_TIMEOUT': RECOMMENDER_REDIS_TIMEOUT,
+})
+
+
+# METRICS
+
+# Queries, database time, cache hits and misses, Redis calls and latency
+# of requests per URL name, exposed for Prometheus on /metrics
+METRICS_ENABLED = int(os.environ.get('METRICS_ENABLED', 0))
+# Bearer token required by /metrics, without it /metrics is served
+# only with DEBUG on
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Share of requests whose SQL is recorded, they are logged with their
+# slowest queries when taking longer than threshold in seconds
+METRICS_SLOW_REQUEST_SAMPLE_RATE = float(
+    os.environ.get('METRICS_SLOW_REQUEST_SAMPLE_RATE', 0.1))
+METRICS_SLOW_REQUEST_THRESHOLD = float(
+    os.environ.get('METRICS_SLOW_REQUEST_THRESHOLD', 0.5))
+METRICS_SLOW_REQUEST_TOP_QUERIES = 5
+# Port Celery workers expose task metrics on, 0 turns it off
+METRICS_WORKER_PORT = int(os.environ.get('METRICS_WORKER_PORT', 9540))
+
+if METRICS_ENABLED:
+    # First, so latency covers the whole middleware stack
+    MIDDLEWARE.insert(0, 'games.middlewares.metrics_middleware')
+    for cache_settings in CACHES.values():
+        cache_settings['BACKEND'] = 'games.metrics.InstrumentedRedisCache'
+        cache_settings['OPTIONS']['REDIS_CLIENT_CLASS'] = (
+            'games.metrics.InstrumentedRedis')
+
+
+# QUERY PROFILING
+
+# Queries slower than threshold in seconds are logged with the view or
+# task and the line of games/ issuing them to a rotating file, shown to
+# staff in admin. A share of them is logged with EXPLAIN plan.
+QUERY_PROFILING_ENABLED = int(os.environ.get('QUERY_PROFILING_ENABLED', 0))
+QUERY_PROFILING_THRESHOLD = float(
+    os.environ.get('QUERY_PROFILING_THRESHOLD', 0.1))
+QUERY_PROFILING_EXPLAIN_SAMPLE_RATE = float(
+    os.environ.get('QUERY_PROFILING_EXPLAIN_SAMPLE_RATE', 0.1))
+# Share of explained queries run again with EXPLAIN (ANALYZE, BUFFERS)
+# for actual timing, which doubles their load on the database
+QUERY_PROFILING_ANALYZE_SAMPLE_RATE = float(
+    os.environ.get('QUERY_PROFILING_ANALYZE_SAMPLE_RATE', 0))
+# Views under tuning get plans of all their slow queries
+QUERY_PROFILING_ALWAYS_EXPLAIN = [
+    'games:search',
+    'games:api-orders-per-day',
+    'games:api-most-bought-products',
+    'games:api-order-stats',
+]
+QUERY_PROFILING_LOG = os.environ.get(
+    'QUERY_PROFILING_LOG', os.path.join(BASE_DIR, 'logs', 'slow_queries.log'))
+QUERY_PROFILING_LOG_MAX_BYTES = 10 * 1024 * 1024
+QUERY_PROFILING_LOG_BACKUP_COUNT = 5
+
+if QUERY_PROFILING_ENABLED:
+    MIDDLEWARE.insert(0, 'games.middlewares.query_profiling_middleware')
+
 
 # ALLAUTH
 
@@ -252,6 +400,29 @@ COUNTRIES_ONLY = ['GB', 'US']
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER', 'redis://127.0.0.1:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_BROKER', 'redis://127.0.0.1:6379/0')
 
+# Queues in order of priority: order confirmations must not wait
+# behind mass mailing, exports or cleanups
+CELERY_TASK_QUEUES = (
+    Queue('transactional'),
+    Queue('bulk'),
+    Queue('maintenance'),
+)
+CELERY_TASK_DEFAULT_QUEUE = 'transactional'
+CELERY_TASK_ROUTES = {
+    'games.tasks.order_created': {'queue': 'transactional'},
+    'games.tasks.send_order_confirmations': {'queue': 'transactional'},
+    'games.tasks.contact_us_form_filled': {'queue': 'bulk'},
+    'games.tasks.export_to_csv_file': {'queue': 'bulk'},
+    'games.tasks.delete_unactive_carts': {'queue': 'maintenance'},
+    'games.tasks.reconcile_daily_order_stats': {'queue': 'maintenance'},
+    'games.tasks.reconcile_daily_product_stats': {'queue': 'maintenance'},
+}
+# Worker consuming several queues drains them in the order given by -Q
+CELERY_BROKER_TRANSPORT_OPTIONS = {'queue_order_strategy': 'priority'}
+# Long tasks are not reserved in advance by busy worker processes,
+# prefetch of short tasks is raised per worker in docker-compose.yml
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
 
 # WEBPACK LOADER
 
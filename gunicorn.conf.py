@@ -0,0 +1,45 @@
+"""
+Gunicorn configuration of production serving mode, see
+scripts/entrypoint.sh. Settings can be overridden with environment
+variables.
+"""
+import multiprocessing
+import os
+
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Processes tuned by core count, more threads or an ASGI worker class
+# (uvicorn.workers.UvicornWorker) help I/O bound requests
+workers = int(os.environ.get(
+    'WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'sync')
+
+# Load application once in master, workers are forked with it ready
+preload_app = True
+
+# Recycle workers gracefully to release leaked memory, jitter keeps
+# them from restarting all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # Connections opened while preloading must not be shared by workers
+    from django.db import connections
+    for conn in connections.all():
+        conn.close()
+
+
+def child_exit(server, worker):
+    # Metrics of exited worker are not summed up with live ones any more
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
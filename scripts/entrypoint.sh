@@ -1,5 +1,28 @@
 #!/bin/bash
 
 python manage.py migrate
+# With DEBUG off every server mode serves static files from STATIC_ROOT
+python manage.py collectstatic --noinput
 
-python manage.py runserver 0.0.0.0:8000
+# Gunicorn workers share request metrics through files of this directory
+start_metrics() {
+    export prometheus_multiproc_dir="${prometheus_multiproc_dir:-/tmp/prometheus}"
+    rm -rf "$prometheus_multiproc_dir"
+    mkdir -p "$prometheus_multiproc_dir"
+}
+
+# SERVER_MODE: development (runserver), wsgi or asgi (gunicorn)
+case "${SERVER_MODE:-development}" in
+    wsgi)
+        start_metrics
+        exec gunicorn games_ecommerce.wsgi:application -c gunicorn.conf.py
+        ;;
+    asgi)
+        start_metrics
+        exec gunicorn games_ecommerce.asgi:application -c gunicorn.conf.py \
+            -k uvicorn.workers.UvicornWorker
+        ;;
+    *)
+        python manage.py runserver 0.0.0.0:8000
+        ;;
+esac
@@ -0,0 +1,124 @@
+"""
+Load test of pages of Games4Everyone, reports requests per second and
+latency of every served application.
+
+Test running server:
+    python scripts/loadtest.py --url http://localhost:8000
+
+Start gunicorn with WSGI and ASGI application one after another and
+compare them:
+    python scripts/loadtest.py --app wsgi --app asgi
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import requests
+
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APPS = {
+    'wsgi': ['games_ecommerce.wsgi:application'],
+    'asgi': ['games_ecommerce.asgi:application',
+             '-k', 'uvicorn.workers.UvicornWorker'],
+}
+DEFAULT_PATHS = ['/', '/about-us/', '/static/css/custom.css']
+
+
+def worker(url, paths, deadline, results):
+    """
+    Request paths in turn until deadline, keeping the connection open.
+    """
+    session = requests.Session()
+    latencies, errors = [], 0
+    while time.monotonic() < deadline:
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                response = session.get(url + path, timeout=10)
+                if response.status_code >= 400:
+                    errors += 1
+            except requests.RequestException:
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+    results.append((latencies, errors))
+
+
+def run(url, paths, concurrency, duration):
+    results = []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=worker,
+                                args=(url, paths, deadline, results))
+               for _ in range(concurrency)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(x for result in results for x in result[0])
+    errors = sum(result[1] for result in results)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': len(latencies) / elapsed,
+        'mean': statistics.mean(latencies) if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] if latencies else 0,
+    }
+
+
+def wait_until_ready(url, server=None, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server and server.poll() is not None:
+            break
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.5)
+    raise RuntimeError('Server at {} did not start'.format(url))
+
+
+def start_server(app, bind):
+    command = ['gunicorn', *APPS[app], '-c', 'gunicorn.conf.py',
+               '--bind', bind, '--access-logfile', os.devnull]
+    return subprocess.Popen(command, cwd=BASE_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--app', action='append', choices=sorted(APPS),
+                        help='start gunicorn with application and test it')
+    parser.add_argument('--path', action='append', dest='paths')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=30)
+    args = parser.parse_args()
+
+    paths = args.paths or DEFAULT_PATHS
+    bind = args.url.split('://', 1)[-1]
+    print('{0:<8} {1:>9} {2:>7} {3:>9} {4:>10} {5:>10}'.format(
+        'app', 'requests', 'errors', 'req/s', 'mean ms', 'p95 ms'))
+
+    for app in args.app or ['running']:
+        server = start_server(app, bind) if args.app else None
+        try:
+            wait_until_ready(args.url, server)
+            report = run(args.url, paths, args.concurrency, args.duration)
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+        print('{0:<8} {requests:>9} {errors:>7} {rps:>9.1f} '
+              '{mean:>10.2f} {p95:>10.2f}'.format(app, **report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+# Celery pool processes share task metrics through files of this
+# directory, files left by processes of the previous run are removed
+if [ -n "$prometheus_multiproc_dir" ]; then
+    rm -rf "$prometheus_multiproc_dir"
+    mkdir -p "$prometheus_multiproc_dir"
+fi
+
+exec "$@"